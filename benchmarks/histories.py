@@ -0,0 +1,18 @@
+"""Announcement histories shared by the benchmarks"""
+
+import datetime
+
+
+def history(size, expired=0):
+    """Return ``size`` announcements, the oldest ``expired`` of them past lifetime"""
+    now = datetime.datetime.now()
+    return [
+        dict(
+            id=i + 1,
+            user=f"user{i % 10}",
+            announcement=f"<p>Maintenance on <strong>2024-01-{i % 28 + 1:02d}</strong></p>",
+            timestamp=now
+            - datetime.timedelta(days=8 if i < expired else 1, seconds=size - i),
+        )
+        for i in range(size)
+    ]
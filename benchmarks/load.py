@@ -0,0 +1,228 @@
+"""Load test the announcement service endpoints
+
+Runs AnnouncementService in this process with hub authentication stubbed
+out, restores a history of each size from a temporary persistence file
+and drives each endpoint with a number of concurrent clients. Results
+(requests per second, p50 and p99 latency, peak RSS) are written as JSON,
+and compared against an earlier run given with --baseline.
+
+    python benchmarks/load.py --sizes 10 1000 --concurrency 1 10 50 \\
+        --output load.json
+
+Clients run in the same process and event loop as the service, so the
+numbers include their overhead; they are meant for comparing runs on
+the same machine, not for capacity planning.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import platform
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+import tornado
+from tornado.httpserver import HTTPServer
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.testing import bind_unused_port
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# Runs from a checkout without installing the package; histories is
+# shared with the other benchmarks next to this script
+sys.path[:0] = [str(ROOT_DIR), str(ROOT_DIR / "benchmarks")]
+
+from histories import history
+
+from jupyterhub_announcement.announcement import AnnouncementService
+from jupyterhub_announcement.handlers import (
+    AnnouncementHandler,
+    AnnouncementUpdateHandler,
+)
+from jupyterhub_announcement.queue import AnnouncementQueue
+
+USER = {"name": "admin", "admin": True, "scopes": []}
+
+# Name to (method, path, whether to send the current validator)
+SCENARIOS = {
+    "latest": ("GET", "latest", False),
+    "latest-304": ("GET", "latest", True),
+    "list": ("GET", "list?limit=20", False),
+    "view": ("GET", "", False),
+    "update": ("POST", "update", False),
+}
+
+
+def stub_hub_auth():
+    """Authenticate every request as USER without asking a hub"""
+    AnnouncementHandler.get_current_user = lambda self: USER
+    AnnouncementUpdateHandler.check_xsrf_cookie = lambda self: None
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def start_service(directory, size):
+    persist_path = str(Path(directory) / f"announcements-{size}.json")
+    await AnnouncementQueue(persist_path=persist_path).storage.save(history(size))
+    app = AnnouncementService(
+        config_file="",
+        cookie_secret_file=str(Path(directory) / "cookie-secret"),
+        template_paths=[str(ROOT_DIR / "templates")],
+        log_level=logging.WARNING,
+    )
+    app.config.AnnouncementQueue.persist_path = persist_path
+    app.initialize([])
+    sock, port = bind_unused_port()
+    server = HTTPServer(app.app)
+    server.add_sockets([sock])
+    return app, server, f"http://127.0.0.1:{port}{app.service_prefix}"
+
+
+async def run_scenario(url, scenario, concurrency, requests):
+    method, path, conditional = SCENARIOS[scenario]
+    client = SimpleAsyncHTTPClient(max_clients=concurrency, force_instance=True)
+    headers = {"Accept-Encoding": "gzip"}
+    if conditional:
+        response = await client.fetch(url + path)
+        headers["If-None-Match"] = response.headers["Etag"]
+    latencies = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal errors, remaining
+        while remaining > 0:
+            remaining -= 1
+            body = None
+            if method == "POST":
+                body = urlencode(dict(announcement=f"<p>update {remaining}</p>"))
+            start = time.perf_counter()
+            response = await client.fetch(
+                url + path,
+                method=method,
+                body=body,
+                headers=headers,
+                follow_redirects=False,
+                raise_error=False,
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.code >= 400 or response.code == 599:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    client.close()
+    latencies.sort()
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        rps=len(latencies) / elapsed,
+        p50_ms=1000 * percentile(latencies, 0.5),
+        p99_ms=1000 * percentile(latencies, 0.99),
+        max_rss_mb=peak_rss_mb(),
+    )
+
+
+async def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            app, server, url = await start_service(directory, size)
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    result = dict(
+                        scenario=scenario,
+                        history=size,
+                        concurrency=concurrency,
+                        **await run_scenario(url, scenario, concurrency, args.requests),
+                    )
+                    results.append(result)
+                    print(
+                        f"{scenario:<12}{size:>8}{concurrency:>6}"
+                        f"{result['rps']:>10.0f}{result['p50_ms']:>9.2f}"
+                        f"{result['p99_ms']:>9.2f}{result['errors']:>8}",
+                        file=sys.stderr,
+                    )
+            server.stop()
+            await server.close_all_connections()
+            await app.queue.flush()
+    return results
+
+
+def compare(results, baseline):
+    """Print the change of throughput and p99 latency against a baseline"""
+    previous = {
+        (r["scenario"], r["history"], r["concurrency"]): r for r in baseline["results"]
+    }
+    print("\nchange against baseline (rps, p99)", file=sys.stderr)
+    for result in results:
+        old = previous.get(
+            (result["scenario"], result["history"], result["concurrency"])
+        )
+        if old is None:
+            continue
+        rps = 100 * (result["rps"] / old["rps"] - 1)
+        p99 = 100 * (result["p99_ms"] / old["p99_ms"] - 1)
+        print(
+            f"{result['scenario']:<12}{result['history']:>8}{result['concurrency']:>6}"
+            f"{rps:>+9.1f}%{p99:>+9.1f}%",
+            file=sys.stderr,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument(
+        "--requests", type=int, default=2000, help="Requests per scenario"
+    )
+    parser.add_argument("--output", help="Write results to this file, not stdout")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare")
+    args = parser.parse_args()
+
+    stub_hub_auth()
+    print(
+        f"{'scenario':<12}{'history':>8}{'conc':>6}{'rps':>10}{'p50 ms':>9}"
+        f"{'p99 ms':>9}{'errors':>8}",
+        file=sys.stderr,
+    )
+    results = asyncio.run(run(args))
+    report = dict(
+        time=datetime.datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        tornado=tornado.version,
+        requests=args.requests,
+        results=results,
+    )
+    if args.baseline:
+        with open(args.baseline) as stream:
+            compare(results, json.load(stream))
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(report, stream, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
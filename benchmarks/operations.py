@@ -0,0 +1,181 @@
+"""Time AnnouncementQueue operations against the size of the queue
+
+For each queue size reports the mean time of an update, of purging a
+tenth of the queue, of persisting a change (one update) and the whole
+queue with every storage class, of restoring the queue, and of encoding
+it as JSON through _JSONEncoder and through the encoder module (orjson
+when installed).
+
+    python benchmarks/operations.py --sizes 10 1000 100000 1000000
+
+Pass --profile to run the benchmarks under cProfile and write the stats
+to a file, for instance to see where the time of the largest size goes.
+"""
+
+import argparse
+import asyncio
+import cProfile
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from traitlets.config import Config
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# Runs from a checkout without installing the package; histories is
+# shared with the other benchmarks next to this script
+sys.path[:0] = [str(ROOT_DIR), str(ROOT_DIR / "benchmarks")]
+
+from histories import history
+
+from jupyterhub_announcement import encoder
+from jupyterhub_announcement.encoder import _JSONEncoder
+from jupyterhub_announcement.queue import AnnouncementQueue
+from jupyterhub_announcement.storage import (
+    JournalStorage,
+    JSONFileStorage,
+    SQLiteStorage,
+)
+
+STORAGE_CLASSES = [JSONFileStorage, JournalStorage, SQLiteStorage]
+
+
+def make_queue(size, expired=0, **kwargs):
+    config = Config(
+        {
+            "Persister": {"delay": 0.0},
+            # Keep the whole queue in memory with SQLite as well
+            "SQLiteStorage": {"window": max(size, 1)},
+        }
+    )
+    queue = AnnouncementQueue(config=config, **kwargs)
+    queue.announcements = history(size, expired)
+    queue._last_id = size
+    return queue
+
+
+async def timed(function, repeat):
+    """Return the mean seconds of ``repeat`` awaited calls of ``function``"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+        if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+            await result
+    return (time.perf_counter() - start) / repeat
+
+
+async def bench_update(size, repeat, directory):
+    queue = make_queue(size)
+    return await timed(lambda: queue.update("admin", "<p>update</p>"), repeat)
+
+
+async def bench_purge(size, repeat, directory):
+    times = []
+    for _ in range(repeat):
+        queue = make_queue(size, expired=size // 10)
+        times.append(await timed(queue.purge, 1))
+    return min(times)
+
+
+async def bench_encode(size, repeat, directory):
+    announcements = history(size)
+    return await timed(lambda: json.dumps(announcements, cls=_JSONEncoder), repeat)
+
+
+async def bench_dumps(size, repeat, directory):
+    announcements = history(size)
+    return await timed(lambda: encoder.dumps(announcements), repeat)
+
+
+def persisting(storage_class):
+    async def bench_persist(size, repeat, directory):
+        path = Path(directory) / f"{storage_class.__name__}-{size}"
+        queue = make_queue(size, persist_path=str(path), storage_class=storage_class)
+        await queue._handle_persist()
+
+        async def update():
+            # Returns once the change is on disk
+            await (await queue.update("admin", "<p>update</p>"))
+
+        return await timed(update, repeat)
+
+    return bench_persist
+
+
+def saving(storage_class):
+    async def bench_save(size, repeat, directory):
+        path = Path(directory) / f"{storage_class.__name__}-{size}"
+        queue = make_queue(size, persist_path=str(path), storage_class=storage_class)
+        return await timed(queue._handle_persist, repeat)
+
+    return bench_save
+
+
+def restoring(storage_class):
+    async def bench_restore(size, repeat, directory):
+        path = Path(directory) / f"{storage_class.__name__}-{size}"
+        queue = make_queue(size, persist_path=str(path), storage_class=storage_class)
+        await queue._handle_persist()
+        return await timed(queue._restore, repeat)
+
+    return bench_restore
+
+
+BENCHMARKS = {
+    "update": bench_update,
+    "purge": bench_purge,
+    "encode": bench_encode,
+    "dumps": bench_dumps,
+}
+for _storage_class in STORAGE_CLASSES:
+    _name = _storage_class.__name__
+    BENCHMARKS[f"persist-{_name}"] = persisting(_storage_class)
+    BENCHMARKS[f"save-{_name}"] = saving(_storage_class)
+    BENCHMARKS[f"restore-{_name}"] = restoring(_storage_class)
+
+
+async def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            # Fewer rounds for large queues, where one already takes long
+            repeat = max(1, min(args.repeat, args.repeat * 1000 // max(size, 1)))
+            for name in args.benchmarks:
+                elapsed = await BENCHMARKS[name](size, repeat, directory)
+                results.append(dict(benchmark=name, size=size, mean_ms=1000 * elapsed))
+                print(f"{name:<28}{size:>10}{repeat:>8}{1000 * elapsed:>14.3f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 1000, 10000, 100000]
+    )
+    parser.add_argument(
+        "--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="Also write results as JSON to this file")
+    parser.add_argument("--profile", help="Write cProfile stats to this file")
+    args = parser.parse_args()
+
+    print(f"{'benchmark':<28}{'size':>10}{'repeat':>8}{'mean ms':>14}")
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+    results = asyncio.run(run(args))
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
+        print(f"cProfile stats written to {args.profile}", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(results, stream, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Time restoring the announcement queue against the size of its history
+
+Writes histories of each size with every storage class to a temporary
+directory and reports the best of a few restores, with the JSON codec
+in use (orjson when installed) and with the standard library one.
+
+    python benchmarks/restore.py --sizes 1000 10000 100000
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from traitlets.config import Config
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# Runs from a checkout without installing the package; histories is
+# shared with the other benchmarks next to this script
+sys.path[:0] = [str(ROOT_DIR), str(ROOT_DIR / "benchmarks")]
+
+from histories import history
+
+from jupyterhub_announcement import encoder
+from jupyterhub_announcement.queue import AnnouncementQueue
+from jupyterhub_announcement.storage import (
+    JournalStorage,
+    JSONFileStorage,
+    SQLiteStorage,
+)
+
+STORAGE_CLASSES = [JSONFileStorage, JournalStorage, SQLiteStorage]
+
+
+def queue(path, storage_class, window):
+    return AnnouncementQueue(
+        persist_path=str(path),
+        storage_class=storage_class,
+        config=Config({"SQLiteStorage": {"window": window}}),
+    )
+
+
+def best_restore(path, storage_class, window, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        restored = queue(path, storage_class, window)
+        times.append(time.perf_counter() - start)
+    return min(times), len(restored)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    codecs = [("orjson", encoder.orjson)] if encoder.orjson else []
+    codecs.append(("json", None))
+    print(f"{'storage':<16}{'codec':<8}{'history':>10}{'loaded':>10}{'restore ms':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for storage_class in STORAGE_CLASSES:
+            for size in args.sizes:
+                path = Path(directory) / f"{storage_class.__name__}-{size}"
+                # Keep the whole history in memory with SQLite as well
+                writer = queue(path, storage_class, size)
+                asyncio.run(writer.storage.save(history(size)))
+                for name, codec in codecs:
+                    encoder.orjson = codec
+                    elapsed, loaded = best_restore(
+                        path, storage_class, size, args.repeat
+                    )
+                    print(
+                        f"{storage_class.__name__:<16}{name:<8}{size:>10}"
+                        f"{loaded:>10}{1000 * elapsed:>12.1f}"
+                    )
+                encoder.orjson = codecs[0][1]
+
+
+if __name__ == "__main__":
+    main()
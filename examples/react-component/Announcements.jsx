@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import Toast from "react-bootstrap/Toast";
 import { AiOutlineNotification } from "@react-icons/all-files/ai/AiOutlineNotification";
 import Col from "react-bootstrap/Col";
@@ -20,34 +20,81 @@ export const timeAgo = new TimeAgo("en-US");
 
 var _ = require("lodash");
 
+const getCookie = (name) => {
+  const match = document.cookie.match(`(?:^|; )${name}=([^;]*)`);
+  return match ? decodeURIComponent(match[1]) : "";
+};
+
 export const Announcements = ({}) => {
-  const stored = JSON.parse(
-    localStorage.getItem("dismissedAnnouncements") || "[]"
-  );
+  // Dismissed announcements are remembered by the service, so they stay
+  // dismissed in every browser of the user
   const [state, setState] = useState({
     announcements: [],
-    // dismissed: new Set(),
-    dismissed: new Set(stored),
+    unread: new Set(),
   });
+  // Entity tag and queue revision of the replica we hold, so unchanged
+  // polls get a 304 and changed ones only carry what changed
+  const etag = useRef(null);
+  const revision = useRef(null);
   console.log(state);
 
+  const fetchUnread = () => {
+    fetch("/services/announcement/list?unread_only=1&limit=100", {
+      method: "GET",
+      redirect: "manual",
+      credentials: "same-origin",
+      cache: "no-cache",
+    })
+      .then((response) => (response.ok ? response.json() : []))
+      .then((unread) => {
+        setState((prev) => ({
+          ...prev,
+          unread: new Set(unread.map((a) => a.id)),
+        }));
+      })
+      .catch((error) => {
+        console.error("Error getting unread announcements", error);
+      });
+  };
+
   const fetchAnnouncements = () => {
-    fetch("/services/announcement/list", {
+    const headers = etag.current ? { "If-None-Match": etag.current } : {};
+    const query = revision.current
+      ? `?since=${encodeURIComponent(revision.current)}`
+      : "";
+    fetch(`/services/announcement/changes${query}`, {
       method: "GET",
       redirect: "manual",
       credentials: "same-origin",
+      cache: "no-cache",
+      headers: headers,
     })
       .then((response) => {
+        if (response.status === 304) {
+          return null;
+        }
         if (!response.ok) {
           console.error("Error fetching announcements", response);
         }
+        etag.current = response.headers.get("ETag");
         return response.json();
       })
-      .then((announcements) => {
-        setState((prev) => ({
-          ...prev,
-          announcements: announcements,
-        }));
+      .then((changes) => {
+        if (changes === null) {
+          return;
+        }
+        revision.current = changes.revision;
+        setState((prev) => {
+          const removed = new Set(changes.removed);
+          const kept = changes.reset
+            ? []
+            : prev.announcements.filter((a) => !removed.has(a.id));
+          return {
+            ...prev,
+            announcements: kept.concat(changes.added),
+          };
+        });
+        fetchUnread();
       })
       .catch((error) => {
         console.error("Error getting announcements", error);
@@ -55,15 +102,22 @@ export const Announcements = ({}) => {
   };
 
   const toggleClose = (announcement) => {
-    state.dismissed.add(announcement.timestamp);
-    localStorage.setItem(
-      "dismissedAnnouncements",
-      JSON.stringify(Array.from(state.dismissed))
-    );
-    setState((prev) => ({
-      ...prev,
-      dismissed: state.dismissed,
-    }));
+    setState((prev) => {
+      const unread = new Set(prev.unread);
+      unread.delete(announcement.id);
+      return { ...prev, unread: unread };
+    });
+    fetch("/services/announcement/read", {
+      method: "POST",
+      credentials: "same-origin",
+      headers: {
+        "Content-Type": "application/json",
+        "X-XSRFToken": getCookie("_xsrf"),
+      },
+      body: JSON.stringify({ ids: [announcement.id] }),
+    }).catch((error) => {
+      console.error("Error dismissing announcement", error);
+    });
   };
 
   useEffect(() => {
@@ -75,7 +129,7 @@ export const Announcements = ({}) => {
   if (_.isEmpty(state.announcements)) return null;
 
   const toasts = state.announcements.flatMap((announcement, index) => {
-    if (state.dismissed.has(announcement.timestamp)) return [];
+    if (!state.unread.has(announcement.id)) return [];
 
     return [
       <Toast
@@ -6,24 +6,60 @@ import sys
 import secrets
 
 from textwrap import dedent
-from jinja2 import ChoiceLoader, FileSystemLoader, PrefixLoader
+from html_sanitizer import Sanitizer
+from html_sanitizer.sanitizer import DEFAULT_SETTINGS
+from jinja2 import (
+    ChoiceLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    PrefixLoader,
+)
 from jupyterhub._data import DATA_FILES_PATH
 from jupyterhub.handlers.static import LogoHandler
 from jupyterhub.log import CoroutineLogFormatter
 from jupyterhub.services.auth import HubOAuthCallbackHandler
 from jupyterhub.utils import url_path_join
-from tornado import ioloop, web
-from traitlets import Any, Bool, Callable, Dict, Integer, List, Unicode, default
+from tornado import httpserver, ioloop, netutil, process, web
+from traitlets import (
+    Any,
+    Bool,
+    Callable,
+    Dict,
+    Float,
+    Integer,
+    List,
+    Unicode,
+    default,
+)
 from traitlets.config import Application
 
+from jupyterhub_announcement import metrics
+from jupyterhub_announcement.auth import CachedHubOAuth, UserCache
+from jupyterhub_announcement.broadcast import BroadcastHub
+from jupyterhub_announcement.compression import ContentEncoding
+from jupyterhub_announcement.extra_info import ExtraInfoCache
 from jupyterhub_announcement.handlers import (
+    AnnouncementBroadcastStatsHandler,
+    AnnouncementChangesHandler,
     AnnouncementLatestHandler,
     AnnouncementListHandler,
+    AnnouncementMetricsHandler,
+    AnnouncementReadHandler,
+    AnnouncementStreamHandler,
     AnnouncementUpdateHandler,
     AnnouncementViewHandler,
+    AnnouncementWebSocketHandler,
 )
+from jupyterhub_announcement.persister import Persister
+from jupyterhub_announcement.profiling import Profiler
 from jupyterhub_announcement.queue import AnnouncementQueue
 from jupyterhub_announcement.ssl import SSLContext
+from jupyterhub_announcement.storage import (
+    JournalStorage,
+    JSONFileStorage,
+    SQLiteStorage,
+)
 
 
 COOKIE_SECRET_BYTES = (
@@ -35,7 +71,18 @@ HEX_RE = re.compile('^([a-f0-9]{2})+$', re.IGNORECASE)
 
 class AnnouncementService(Application):
 
-    classes = [AnnouncementQueue, SSLContext]
+    classes = [
+        AnnouncementQueue,
+        BroadcastHub,
+        ExtraInfoCache,
+        JSONFileStorage,
+        JournalStorage,
+        Persister,
+        Profiler,
+        SQLiteStorage,
+        SSLContext,
+        UserCache,
+    ]
 
     flags = Dict(
         {
@@ -59,6 +106,17 @@ class AnnouncementService(Application):
 
     port = Integer(8888, help="Port this service will listen on").tag(config=True)
 
+    num_processes = Integer(
+        1,
+        help="""Number of worker processes sharing the service port.
+
+        Zero starts one per CPU core. More than one process requires a
+        storage_class shared between processes, like SQLiteStorage; each
+        worker then picks up changes made by the others within
+        AnnouncementQueue.refresh_interval seconds. Only the first worker
+        purges the queue.""",
+    ).tag(config=True)
+
     default_limit = Integer(
         5,
         help=(
@@ -67,8 +125,67 @@ class AnnouncementService(Application):
         )
     ).tag(config=True)
 
+    max_limit = Integer(
+        100,
+        help="Maximum number of announcements the list endpoint returns at once",
+    ).tag(config=True)
+
     allow_origin = Bool(False, help="Allow access from subdomains").tag(config=True)
 
+    compress_response = Bool(
+        True,
+        help="""Compress responses for clients accepting it.
+
+        JSON responses are compressed once per queue change and then served
+        from memory, with brotli if it is installed and gzip otherwise.
+        Pages are gzipped as they are sent.""",
+    ).tag(config=True)
+
+    stream_heartbeat_interval = Float(
+        15.0,
+        help="""Seconds between heartbeats on idle announcement streams.
+
+        Heartbeats keep proxies from closing idle server-sent event
+        connections and let the service notice clients that went away.""",
+    ).tag(config=True)
+
+    stream_max_subscribers = Integer(
+        0,
+        help="""Maximum number of concurrent announcement streams.
+
+        Further stream requests are refused with 503 and clients fall back
+        to their reconnect delay. Zero means no limit.""",
+    ).tag(config=True)
+
+    websocket_ping_interval = Float(
+        30.0,
+        help="""Seconds between pings on announcement websockets.
+
+        Connections that don't answer a ping are closed. Zero disables pings.""",
+    ).tag(config=True)
+
+    authenticate_api = Bool(
+        False,
+        help="""Restrict the endpoints announcements are read from to hub users.
+
+        These are latest, list, changes, stream and ws. Users need access
+        to the service, and pages polling or subscribing to these endpoints
+        must send the service cookie or a token. Resolved users are cached
+        as set up by the UserCache options.""",
+    ).tag(config=True)
+
+    authenticate_metrics = Bool(
+        True,
+        help="""Require authentication to read the metrics endpoint.
+
+        Admins and holders of one of metrics_scopes may read it.""",
+    ).tag(config=True)
+
+    metrics_scopes = List(
+        ["read:metrics"],
+        help="Hub scopes allowing to read the metrics endpoint",
+    ).tag(config=True)
+
     data_files_path = Unicode(DATA_FILES_PATH, help="Location of JupyterHub data files")
 
     template_paths = List(
@@ -82,6 +199,22 @@ class AnnouncementService(Application):
             os.path.join(self.data_files_path, "templates"),
         ]
 
+    template_auto_reload = Bool(
+        False,
+        help="""Check templates for changes on every page load.
+
+        Useful while developing templates. Otherwise templates are loaded
+        once and edits need a service restart.""",
+    ).tag(config=True)
+
+    template_bytecode_cache_dir = Unicode(
+        "",
+        help="""Directory in which to cache compiled templates.
+
+        Speeds up loading templates when the service starts. Leave empty
+        to compile templates on every start.""",
+    ).tag(config=True)
+
     logo_file = Unicode(
         "",
         help="Logo path, can be used to override JupyterHub one",
@@ -101,6 +234,38 @@ class AnnouncementService(Application):
          live system status page or MOTD.""",
     ).tag(config=True)
 
+    allowed_tags = List(
+        Unicode(),
+        [
+            "a", "h1", "h2", "h3", "strong", "em", "p",
+            "ul", "ol", "li", "br", "sub", "sup", "hr",
+        ],
+        help="HTML tags allowed in announcements, others are removed",
+    ).tag(config=True)
+
+    allowed_attributes = Dict(
+        {"a": ["href", "name", "target", "title", "rel"]},
+        help="""HTML attributes allowed in announcements, by tag.
+
+        Attributes of tags missing from allowed_tags are ignored. Allowing
+        target on links needs rel to be allowed as well.""",
+    ).tag(config=True)
+
+    max_announcement_size = Integer(
+        65536,
+        help="""Maximum number of characters in a submitted announcement.
+
+        Longer submissions are rejected before they are sanitized. Zero
+        means no limit.""",
+    ).tag(config=True)
+
+    sanitize_executor_size = Integer(
+        4096,
+        help="""Announcements longer than this many characters are sanitized in a thread.
+
+        Sanitizing a large submission then doesn't hold up other requests.""",
+    ).tag(config=True)
+
     ssl_context = Any()
 
     cookie_secret_file = Unicode(
@@ -111,7 +276,10 @@ class AnnouncementService(Application):
     extra_info_hook = Callable(
         None,
         allow_none=True,
-        help="Async callable to add extra info to the latest announcement.",
+        help="""Async callable to add extra info to the latest announcement.
+
+        It is called with the request handler; results are cached as set
+        up by the ExtraInfoCache options.""",
     ).tag(config=True)
 
     _log_formatter_cls = CoroutineLogFormatter
@@ -138,7 +306,19 @@ class AnnouncementService(Application):
         #       self.log.parent.setLevel(self.log.level)
 
         self.init_logging()
+        self.init_auth()
         self.init_queue()
+        if self.num_processes != 1 and not self.queue.shared:
+            self.log.error(
+                "num_processes other than 1 needs a storage_class shared between "
+                "processes, like jupyterhub_announcement.storage.SQLiteStorage"
+            )
+            sys.exit(1)
+        self.init_broadcast()
+        self.init_extra_info()
+        self.init_sanitizer()
+        self.init_metrics()
+        self.init_profiler()
         self.init_ssl_context()
         self.init_secrets()
 
@@ -151,6 +331,15 @@ class AnnouncementService(Application):
                 FileSystemLoader(self.template_paths),
             ]
         )
+        bytecode_cache = None
+        if self.template_bytecode_cache_dir:
+            os.makedirs(self.template_bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(self.template_bytecode_cache_dir)
+        self.env = Environment(
+            loader=loader,
+            auto_reload=self.template_auto_reload,
+            bytecode_cache=bytecode_cache,
+        )
 
         self.settings = {
             "cookie_secret": self.cookie_secret,
@@ -158,7 +347,10 @@ class AnnouncementService(Application):
             "static_url_prefix": url_path_join(self.service_prefix, "static/"),
             "log": self.log,
             "xsrf_cookies": True,
+            "websocket_ping_interval": self.websocket_ping_interval,
+            "compress_response": self.compress_response,
         }
+        transforms = [ContentEncoding] if self.compress_response else []
 
         self.app = web.Application(
             [
@@ -168,8 +360,9 @@ class AnnouncementService(Application):
                     dict(
                         queue=self.queue,
                         fixed_message=self.fixed_message,
-                        loader=loader,
+                        env=self.env,
                         service_prefix=self.service_prefix,
+                        allowed_tags=self.allowed_tags,
                     ),
                     "view",
                 ),
@@ -180,19 +373,78 @@ class AnnouncementService(Application):
                     dict(
                         queue=self.queue,
                         allow_origin=self.allow_origin,
-                        extra_info_hook=self.extra_info_hook,
+                        extra_info=self.extra_info,
+                        authenticate=self.authenticate_api,
+                    ),
+                ),
+                (
+                    self.service_prefix + r"stream",
+                    AnnouncementStreamHandler,
+                    dict(
+                        queue=self.queue,
+                        allow_origin=self.allow_origin,
+                        heartbeat_interval=self.stream_heartbeat_interval,
+                        max_subscribers=self.stream_max_subscribers,
+                        authenticate=self.authenticate_api,
+                    ),
+                ),
+                (
+                    self.service_prefix + r"ws",
+                    AnnouncementWebSocketHandler,
+                    dict(
+                        broadcast=self.broadcast,
+                        allow_origin=self.allow_origin,
+                        authenticate=self.authenticate_api,
+                    ),
+                ),
+                (
+                    self.service_prefix + r"ws/stats",
+                    AnnouncementBroadcastStatsHandler,
+                    dict(queue=self.queue, broadcast=self.broadcast),
+                ),
+                (
+                    self.service_prefix + r"changes",
+                    AnnouncementChangesHandler,
+                    dict(
+                        queue=self.queue,
+                        allow_origin=self.allow_origin,
+                        authenticate=self.authenticate_api,
                     ),
                 ),
                 (
                     self.service_prefix + r"list", AnnouncementListHandler,
                     dict(
-                        queue=self.queue, allow_origin=self.allow_origin, default_limit=self.default_limit,
+                        queue=self.queue,
+                        allow_origin=self.allow_origin,
+                        default_limit=self.default_limit,
+                        max_limit=self.max_limit,
+                        authenticate=self.authenticate_api,
                     ),
                 ),
+                (
+                    self.service_prefix + r"read",
+                    AnnouncementReadHandler,
+                    dict(queue=self.queue),
+                ),
                 (
                     self.service_prefix + r"update",
                     AnnouncementUpdateHandler,
-                    dict(queue=self.queue),
+                    dict(
+                        queue=self.queue,
+                        sanitizer=self.sanitizer,
+                        max_size=self.max_announcement_size,
+                        executor_size=self.sanitize_executor_size,
+                    ),
+                ),
+                (
+                    self.service_prefix + r"metrics",
+                    AnnouncementMetricsHandler,
+                    dict(
+                        queue=self.queue,
+                        registry=self.metrics_registry,
+                        authenticate=self.authenticate_metrics,
+                        scopes=self.metrics_scopes,
+                    ),
                 ),
                 (
                     self.service_prefix + r"static/(.*)",
@@ -201,6 +453,7 @@ class AnnouncementService(Application):
                 ),
                 (self.service_prefix + r"logo", LogoHandler, {"path": self.logo_file}),
             ],
+            transforms=transforms,
             **self.settings,
         )
 
@@ -263,19 +516,77 @@ class AnnouncementService(Application):
         # store the loaded trait value
         self.cookie_secret = secret
 
+    def init_auth(self):
+        # Handlers get the instance made here, configured like the service
+        CachedHubOAuth.clear_instance()
+        self.hub_auth = CachedHubOAuth.instance(config=self.config)
+
     def init_queue(self):
         self.queue = AnnouncementQueue(log=self.log, config=self.config)
 
+    def init_broadcast(self):
+        self.broadcast = BroadcastHub(self.queue, log=self.log, config=self.config)
+
+    def init_extra_info(self):
+        self.extra_info = None
+        if self.extra_info_hook:
+            self.extra_info = ExtraInfoCache(
+                self.extra_info_hook, log=self.log, config=self.config
+            )
+
+    def init_sanitizer(self):
+        tags = set(self.allowed_tags)
+        try:
+            self.sanitizer = Sanitizer(
+                dict(
+                    tags=tags,
+                    attributes={
+                        tag: attributes
+                        for tag, attributes in self.allowed_attributes.items()
+                        if tag in tags
+                    },
+                    empty=tags & DEFAULT_SETTINGS["empty"],
+                    separate=tags & DEFAULT_SETTINGS["separate"],
+                )
+            )
+        except TypeError as e:
+            self.log.error(f"Invalid allowed_tags or allowed_attributes: {e}")
+            sys.exit(1)
+
+    def init_metrics(self):
+        self.metrics_registry = metrics.make_registry(
+            metrics.ServiceCollector(
+                self.queue,
+                self.broadcast,
+                AnnouncementStreamHandler,
+                self.extra_info,
+                self.hub_auth.user_cache,
+            )
+        )
+
+    def init_profiler(self):
+        self.profiler = Profiler(log=self.log, config=self.config)
+
     def init_ssl_context(self):
         self.ssl_context = SSLContext(config=self.config).ssl_context()
 
     def start(self):
-        self.app.listen(self.port, ssl_options=self.ssl_context)
-
-        async def purge_loop():
-            await self.queue.purge()
-
-        ioloop.PeriodicCallback(purge_loop, 300000).start()
+        sockets = netutil.bind_sockets(self.port)
+        task_id = None
+        if self.num_processes != 1:
+            task_id = process.fork_processes(self.num_processes)
+            self.log.info(f"worker {task_id} started")
+            self.queue.reseed()
+        server = httpserver.HTTPServer(self.app, ssl_options=self.ssl_context)
+        server.add_sockets(sockets)
+
+        self.profiler.install()
+        if not task_id:
+            self.queue.start_expiry()
+        if self.queue.shared and self.queue.refresh_interval:
+            ioloop.PeriodicCallback(
+                self.queue.refresh, self.queue.refresh_interval * 1000
+            ).start()
         ioloop.IOLoop.current().start()
 
 
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from jupyterhub.services.auth import HubOAuth
+from traitlets import Float, Instance, Integer, default
+from traitlets.config import LoggingConfigurable
+
+
+class UserCache(LoggingConfigurable):
+    """Bounded cache of user models resolved by the hub
+
+    Models are reused for ``ttl`` seconds, the least recently used one is
+    dropped beyond ``max_entries``. Concurrent lookups of the same key
+    share one request to the hub. Failed lookups are not cached."""
+
+    ttl = Float(
+        60.0,
+        help="""Seconds to reuse a user model resolved by the hub.
+
+        This bounds how long a token revoked by other means than logging
+        out keeps working. Zero disables caching.""",
+    ).tag(config=True)
+
+    max_entries = Integer(
+        10000,
+        help="Maximum number of cached user models",
+    ).tag(config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Key to (user model, time of the lookup), least recently used first
+        self._models = OrderedDict()
+        # Key to the lookup in progress
+        self._lookups = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._models)
+
+    def stats(self):
+        return dict(
+            entries=len(self._models),
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+        )
+
+    async def get(self, key, lookup):
+        """Return the user model for ``key``, awaiting ``lookup()`` if needed"""
+        cached = self._models.get(key)
+        if cached is not None:
+            if time.monotonic() - cached[1] < self.ttl:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            del self._models[key]
+        task = self._lookups.get(key)
+        # The hub auth thread resolves users on a loop of its own
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        self.misses += 1
+        task = self._lookups[key] = asyncio.ensure_future(self._lookup(key, lookup))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, key, lookup):
+        start = time.monotonic()
+        try:
+            model = await lookup()
+        finally:
+            del self._lookups[key]
+        if self.ttl:
+            self._models[key] = (model, start)
+            if len(self._models) > self.max_entries:
+                self._models.popitem(last=False)
+        return model
+
+    def invalidate(self, key=None):
+        """Forget the user model for ``key``, or all of them"""
+        if key is None:
+            self._models.clear()
+        else:
+            self._models.pop(key, None)
+
+
+class CachedHubOAuth(HubOAuth):
+    """HubOAuth resolving users through a UserCache
+
+    Cache keys combine the token with the hub session id, so logging out
+    of the hub, which ends the session, takes effect right away."""
+
+    user_cache = Instance(UserCache)
+
+    @default("user_cache")
+    def _default_user_cache(self):
+        return UserCache(parent=self, log=self.log)
+
+    def get_user(self, handler, *, sync=True):
+        if sync and hasattr(handler, "_cached_hub_user"):
+            # Resolved already, skip the round trip through the auth thread
+            return handler._cached_hub_user
+        return super().get_user(handler, sync=sync)
+
+    # Overrides a private HubOAuth method; the signature is the one of
+    # JupyterHub 6, check it when upgrading JupyterHub
+    async def _check_hub_authorization(
+        self, url, api_token, cache_key=None, use_cache=True
+    ):
+        if not use_cache:
+            return await super()._check_hub_authorization(
+                url, api_token, use_cache=False
+            )
+        return await self.user_cache.get(
+            cache_key,
+            lambda: super(CachedHubOAuth, self)._check_hub_authorization(
+                url, api_token, use_cache=False
+            ),
+        )
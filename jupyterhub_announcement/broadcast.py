@@ -0,0 +1,113 @@
+from tornado import ioloop
+from tornado.websocket import WebSocketClosedError
+from traitlets import Enum, Float, Integer
+from traitlets.config import LoggingConfigurable
+
+
+class BroadcastHub(LoggingConfigurable):
+    """Fan out the latest announcement to websocket connections
+
+    Every connection receives the same encoded payload. Changes landing
+    within ``batch_delay`` of each other are sent as one message, and each
+    connection may only have ``max_pending`` unfinished writes. Since a
+    message always carries the latest announcement, a connection that
+    falls behind can skip intermediate ones without losing state."""
+
+    batch_delay = Float(
+        0.05,
+        help="Seconds to wait for further queue changes before broadcasting",
+    ).tag(config=True)
+
+    max_pending = Integer(
+        4,
+        help="Maximum number of unfinished writes per connection",
+    ).tag(config=True)
+
+    max_subscribers = Integer(
+        0,
+        help="Maximum number of websocket connections, zero means no limit",
+    ).tag(config=True)
+
+    slow_consumer_policy = Enum(
+        ["drop", "disconnect"],
+        "drop",
+        help="""What to do with a connection that has max_pending unfinished writes.
+
+        With "drop" the message is skipped and the connection gets the latest
+        announcement once its writes complete. With "disconnect" the
+        connection is closed and the client has to reconnect.""",
+    ).tag(config=True)
+
+    def __init__(self, queue, **kwargs):
+        super().__init__(**kwargs)
+        self.queue = queue
+        self.connections = set()
+        self.sent = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self._scheduled = None
+        self.queue.add_listener(self._schedule)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def stats(self):
+        return dict(
+            subscribers=len(self.connections),
+            sent=self.sent,
+            dropped=self.dropped,
+            disconnected=self.disconnected,
+        )
+
+    def full(self):
+        return bool(self.max_subscribers) and len(self) >= self.max_subscribers
+
+    def subscribe(self, connection):
+        """Add a connection and send it the latest announcement"""
+        connection.pending = 0
+        connection.stale = False
+        self.connections.add(connection)
+        self.send(connection, self.queue.latest_payload())
+
+    def unsubscribe(self, connection):
+        self.connections.discard(connection)
+
+    def _schedule(self):
+        if self._scheduled is None:
+            self._scheduled = ioloop.IOLoop.current().call_later(
+                self.batch_delay, self.broadcast
+            )
+
+    def broadcast(self):
+        self._scheduled = None
+        payload = self.queue.latest_payload()
+        for connection in list(self.connections):
+            self.send(connection, payload)
+
+    def send(self, connection, payload):
+        if connection.pending >= self.max_pending:
+            if self.slow_consumer_policy == "disconnect":
+                self.log.warning("disconnecting slow announcement subscriber")
+                self.disconnected += 1
+                self.unsubscribe(connection)
+                connection.close(1013, "Too slow")
+            else:
+                self.dropped += 1
+                connection.stale = True
+            return
+        try:
+            future = connection.write_message(payload)
+        except WebSocketClosedError:
+            self.unsubscribe(connection)
+            return
+        self.sent += 1
+        connection.pending += 1
+        future.add_done_callback(lambda f: self._write_done(connection, f))
+
+    def _write_done(self, connection, future):
+        connection.pending -= 1
+        if future.exception() is not None:
+            self.unsubscribe(connection)
+        elif connection.stale and connection in self.connections:
+            connection.stale = False
+            self.send(connection, self.queue.latest_payload())
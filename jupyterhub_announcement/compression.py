@@ -0,0 +1,63 @@
+import gzip
+
+from tornado import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Content codings in order of preference, brotli only if it is installed
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+# Shorter payloads are not worth the encoding overhead
+MIN_LENGTH = web.GZipContentEncoding.MIN_LENGTH
+
+
+def negotiate(accept_encoding):
+    """Return the preferred content coding acceptable to a client, if any
+
+    ``accept_encoding`` is the value of an Accept-Encoding header. Codings
+    with a higher quality value win, ties go to the order of ENCODINGS."""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    wildcard = accepted.get("*", 0.0)
+    best = None
+    for coding in ENCODINGS:
+        quality = accepted.get(coding, wildcard)
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (coding, quality)
+    return best and best[0]
+
+
+def compress(payload, encoding):
+    """Return ``payload`` compressed with the content coding ``encoding``
+
+    Payloads are compressed once and then served many times, so this uses
+    the highest compression levels."""
+    if encoding == "br":
+        return brotli.compress(payload, quality=11)
+    if encoding == "gzip":
+        return gzip.compress(payload, compresslevel=9, mtime=0)
+    raise ValueError(f"Unsupported content coding {encoding!r}")
+
+
+class ContentEncoding(web.GZipContentEncoding):
+    """Gzip responses not already compressed by their handler
+
+    Event streams are left alone, a compressor kept for every open stream
+    would cost more memory than their small events save."""
+
+    def _compressible_type(self, ctype):
+        return ctype != "text/event-stream" and super()._compressible_type(ctype)
@@ -1,9 +1,28 @@
 import datetime
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class _JSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime.datetime):
             return obj.isoformat()
         return json.JSONEncoder.default(self, obj)
+
+
+def dumps(obj, indent=False):
+    """Return ``obj`` as JSON text, encoded by orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+    return json.dumps(obj, cls=_JSONEncoder, indent=2 if indent else None)
+
+
+def loads(text):
+    """Return the object in JSON ``text``, decoded by orjson if it is installed"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
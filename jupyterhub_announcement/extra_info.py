@@ -0,0 +1,154 @@
+import asyncio
+import datetime
+import time
+
+from tornado import gen
+from traitlets import Bool, Float, Integer
+from traitlets.config import LoggingConfigurable
+
+from jupyterhub_announcement.metrics import EXTRA_INFO_DURATION_SECONDS
+
+
+class ExtraInfoCache(LoggingConfigurable):
+    """Cache results of the extra_info_hook for the latest endpoint
+
+    Results are reused for ``ttl`` seconds. Concurrent requests missing
+    the cache share one hook call. An expired result is still served for
+    up to ``max_stale`` more seconds while a call in the background
+    refreshes it, and when a call fails or takes longer than ``timeout``.
+    The hook gets the handler of the request that started the call."""
+
+    ttl = Float(
+        60.0,
+        help="Seconds to reuse an extra_info_hook result, zero disables caching",
+    ).tag(config=True)
+
+    max_stale = Float(
+        300.0,
+        help="""Seconds past ttl an extra_info_hook result may still be served.
+
+        Expired results are served while the hook is called again in the
+        background, or when it fails or times out.""",
+    ).tag(config=True)
+
+    timeout = Float(
+        5.0,
+        help="""Seconds a request waits for the extra_info_hook, zero means no limit.
+
+        Requests that time out get the last result, if any, or no extra
+        info. The call itself carries on and its result is cached.""",
+    ).tag(config=True)
+
+    per_user = Bool(
+        False,
+        help="Cache extra_info_hook results separately for every user",
+    ).tag(config=True)
+
+    max_entries = Integer(
+        10000,
+        help="Maximum number of cached extra_info_hook results with per_user",
+    ).tag(config=True)
+
+    def __init__(self, hook, **kwargs):
+        super().__init__(**kwargs)
+        self.hook = hook
+        # Cache key to (result, time of the call)
+        self._results = {}
+        # Cache key to the hook call in progress
+        self._calls = {}
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def stats(self):
+        return dict(
+            entries=len(self._results),
+            hits=self.hits,
+            misses=self.misses,
+            calls=self.calls,
+            errors=self.errors,
+            timeouts=self.timeouts,
+        )
+
+    def key(self, handler):
+        if not self.per_user:
+            return None
+        user = handler.get_current_user()
+        return user and user["name"]
+
+    async def get(self, handler):
+        """Return the extra info for a request to ``handler``"""
+        key = self.key(handler)
+        now = time.monotonic()
+        cached = self._results.get(key)
+        if cached is not None:
+            result, called = cached
+            age = now - called
+            if age < self.ttl:
+                self.hits += 1
+                return result
+            if age < self.ttl + self.max_stale:
+                self.hits += 1
+                self._call(key, handler)
+                return result
+        self.misses += 1
+        call = self._call(key, handler)
+        try:
+            if self.timeout:
+                call = gen.with_timeout(
+                    datetime.timedelta(seconds=self.timeout),
+                    call,
+                    quiet_exceptions=Exception,
+                )
+            return await call
+        except gen.TimeoutError:
+            self.timeouts += 1
+            self.log.warning(
+                f"extra_info_hook took longer than {self.timeout}s "
+                f"({self.timeouts} timeouts)"
+            )
+        except Exception:
+            # Already logged by the call
+            pass
+        if cached is not None and now - cached[1] < self.ttl + self.max_stale:
+            return cached[0]
+        return None
+
+    def _call(self, key, handler):
+        """Return the hook call for ``key``, starting one if there is none"""
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.ensure_future(self._run(key, handler))
+            # Nobody may be waiting for a background refresh
+            call.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return call
+
+    async def _run(self, key, handler):
+        self.calls += 1
+        start = time.monotonic()
+        status = "failure"
+        try:
+            result = await self.hook(handler)
+        except Exception:
+            self.errors += 1
+            self.log.exception(f"extra_info_hook failed ({self.errors} errors)")
+            raise
+        else:
+            status = "success"
+            if self.ttl:
+                self._store(key, result)
+            return result
+        finally:
+            del self._calls[key]
+            duration = time.monotonic() - start
+            EXTRA_INFO_DURATION_SECONDS.labels(status).observe(duration)
+            self.log.debug(f"extra_info_hook took {1000 * duration:.1f}ms")
+
+    def _store(self, key, result):
+        self._results.pop(key, None)
+        if len(self._results) >= self.max_entries:
+            # Entries are ordered by the time of their call
+            del self._results[next(iter(self._results))]
+        self._results[key] = (result, time.monotonic())
@@ -1,35 +1,64 @@
+import datetime
+import email.utils
 import json
 import logging
+from functools import partial
 
-from html_sanitizer import Sanitizer
-from jinja2 import Environment
 from jupyterhub.services.auth import HubOAuthenticated
 from jupyterhub.utils import url_path_join
-from tornado import escape, web
+from markupsafe import Markup
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from tornado import escape, gen, ioloop, locks, web, websocket
+from tornado.httputil import url_concat
+from tornado.iostream import StreamClosedError
 
+from jupyterhub_announcement import compression, metrics
+from jupyterhub_announcement.auth import CachedHubOAuth
 from jupyterhub_announcement.encoder import _JSONEncoder
+from jupyterhub_announcement.queue import audience_keys
 
 
 class AnnouncementHandler(HubOAuthenticated, web.RequestHandler):
+
+    hub_auth_class = CachedHubOAuth
+
+    # Handler label of request metrics
+    metrics_name = "other"
+
+    # Whether requests need the current user
+    authenticate = True
+
     def initialize(self, queue):
         super().initialize()
         self.queue = queue
 
+    async def prepare(self):
+        if self.authenticate:
+            await self.resolve_user()
+
+    async def resolve_user(self):
+        # Resolved on the event loop here, get_current_user would block it
+        await self.hub_auth.get_user(self, sync=False)
+
     @property
     def log(self):
         return self.settings.get("log", logging.getLogger("tornado.application"))
 
+    def on_finish(self):
+        metrics.observe_request(self)
+
 
 class AnnouncementViewHandler(AnnouncementHandler):
     """View announcements page"""
 
-    def initialize(self, queue, fixed_message, loader, service_prefix):
+    metrics_name = "view"
+
+    def initialize(self, queue, fixed_message, env, service_prefix, allowed_tags):
         super().initialize(queue)
         self.fixed_message = fixed_message
-        self.loader = loader
-        self.env = Environment(loader=self.loader)
-        self.template = self.env.get_template("index.html")
+        self.env = env
         self.service_prefix = service_prefix
+        self.allowed_tags = allowed_tags
 
     @web.authenticated
     def get(self):
@@ -37,11 +66,14 @@ class AnnouncementViewHandler(AnnouncementHandler):
         prefix = self.hub_auth.hub_prefix
         logout_url = url_path_join(prefix, "logout")
         update_url = url_path_join(self.service_prefix, "update")
+        # Found in the environment's cache unless templates are auto-reloaded
+        template = self.env.get_template("index.html")
         self.write(
-            self.template.render(
+            template.render(
                 user=user,
                 fixed_message=self.fixed_message,
                 announcements=self.queue.announcements,
+                announcement_list=self.announcement_list(),
                 static_url=self.static_url,
                 login_url=self.hub_auth.login_url,
                 logout_url=logout_url,
@@ -50,67 +82,455 @@ class AnnouncementViewHandler(AnnouncementHandler):
                 parsed_scopes=user.get("scopes") or [],
                 xsrf_form_html=self.xsrf_form_html,
                 update_url=update_url,
+                allowed_tags=self.allowed_tags,
+                scheduled=self.queue.scheduled() if user["admin"] else [],
             )
         )
 
+    def announcement_list(self):
+        """Return the announcements section of the page
+
+        Admins see every announcement, other users those shown to them.
+        Users shown the same announcements share the section."""
+        template = self.env.get_template("announcements.html")
+        user = self.get_current_user()
+        if user["admin"] and self.queue.targeted:
+            return self.queue.cached(
+                ("html", template, "admin"),
+                lambda: Markup(
+                    template.render(announcements=self.queue.announcements, admin=True)
+                ),
+            )
+        keys = self.queue.shown(audience_keys(user))
+        return self.queue.cached(
+            self.queue.audience_key(("html", template), keys),
+            lambda: Markup(template.render(announcements=self.queue.visible(keys))),
+        )
+
 
 class AnnouncementOutputHandler(AnnouncementHandler):
+    """Base class of the JSON endpoints polled by clients
+
+    They are open to anyone unless ``authenticate`` is set, then they
+    are restricted to hub users with access to the service."""
+
+    authenticate = False
+
+    async def prepare(self):
+        if self.authenticate or self.queue.targeted:
+            # Targeted announcements are only shown to identified users
+            await self.resolve_user()
+        if self.authenticate and not self.get_current_user():
+            raise web.HTTPError(403, "Announcements require authentication")
+
+    def audience(self):
+        """Return the audience keys of the current user"""
+        if not (self.authenticate or self.queue.targeted):
+            return frozenset()
+        return audience_keys(self.get_current_user())
+
     def write_output(self, output):
-        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write_payload(
+            escape.utf8(json.dumps(output, cls=_JSONEncoder)), conditional=False
+        )
+
+    def write_payload(self, payload, conditional=True, keys=frozenset()):
+        """Write an already encoded JSON payload
+
+        With ``conditional`` set the payload must reflect the current queue
+        revision for users matching audience ``keys``; validators for it
+        are sent and clients already holding it get an empty 304 response
+        instead. Compressed variants of such payloads are made once per
+        revision."""
         if self.allow_origin:
             self.add_header("Access-Control-Allow-Headers", "Content-Type")
             self.add_header("Access-Control-Allow-Origin", "*")
             self.add_header("Access-Control-Allow-Methods", "OPTIONS,GET")
-        self.write(escape.utf8(json.dumps(output, cls=_JSONEncoder)))
+        encoding = None
+        if conditional and self.settings.get("compress_response"):
+            encoding = self.negotiate_encoding(payload)
+        if conditional:
+            etag = self.queue.etag_for(keys)
+            if encoding:
+                # Each representation needs its own strong validator
+                etag = f'{etag[:-1]}-{encoding}"'
+            if self.queue.shown(keys):
+                # Other users may be shown other announcements
+                self.set_header("Cache-Control", "private, no-cache")
+            else:
+                self.set_header("Cache-Control", "no-cache")
+            self.set_header("Etag", etag)
+            self.set_header("Last-Modified", self.queue.last_modified)
+            if self.not_modified():
+                self.set_status(304)
+                return
+        if encoding:
+            payload = self.queue.cached(
+                ("compressed", encoding, payload),
+                partial(compression.compress, payload, encoding),
+            )
+            self.set_header("Content-Encoding", encoding)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(payload)
+
+    def negotiate_encoding(self, payload):
+        """Return the content coding to send ``payload`` with, if any"""
+        if len(payload) < compression.MIN_LENGTH:
+            return None
+        return compression.negotiate(self.request.headers.get("Accept-Encoding", ""))
+
+    def not_modified(self):
+        """Check request validators against the current queue revision"""
+        if "If-None-Match" in self.request.headers:
+            # If-Modified-Since is ignored when an entity tag is supplied
+            return self.check_etag_header()
+        since = self.request.headers.get("If-Modified-Since")
+        if not since:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return self.queue.last_modified <= since
 
 
 class AnnouncementLatestHandler(AnnouncementOutputHandler):
     """Return the latest announcement as JSON"""
 
-    def initialize(self, queue, allow_origin, extra_info_hook):
+    metrics_name = "latest"
+
+    def initialize(self, queue, allow_origin, extra_info, authenticate=False):
         super().initialize(queue)
         self.allow_origin = allow_origin
-        self.extra_info_hook = extra_info_hook
+        self.extra_info = extra_info
+        self.authenticate = authenticate
+
+    async def prepare(self):
+        await super().prepare()
+        self.query_extra = self.get_query_argument("extra", "none").lower()
+        if self.extra_info and self.extra_info.per_user and self.wants_extra():
+            # Extra info is cached per user, resolved without blocking
+            await self.resolve_user()
+
+    def wants_extra(self):
+        return self.query_extra in ["separate", "combined"]
 
     async def get(self):
-        latest = {"announcement": ""}
-        if self.queue.announcements:
-            latest = dict(self.queue.announcements[-1])
-        query_extra = self.get_query_argument("extra", "none").lower()
-        if self.extra_info_hook and (query_extra in ["separate", "combined"]):
-            extra_info = await self.extra_info_hook(self)
-            if query_extra == "separate":
-                latest["extra"] = extra_info
-            if query_extra == "combined" and extra_info:
-                if latest["announcement"]:
-                    latest["announcement"] += "<br>" + extra_info
-                else:
-                    latest["announcement"] = extra_info
+        query_extra = self.query_extra
+        keys = self.audience()
+        if not (self.extra_info and self.wants_extra()):
+            self.write_payload(self.queue.latest_payload(keys), keys=keys)
+            return
+        extra_info = await self.extra_info.get(self)
+        latest = self.queue.latest(keys)
+        if query_extra == "separate":
+            latest["extra"] = extra_info
+        if query_extra == "combined" and extra_info:
+            if latest["announcement"]:
+                latest["announcement"] += "<br>" + extra_info
+            else:
+                latest["announcement"] = extra_info
         self.write_output(latest)
 
 
+class AnnouncementStreamHandler(AnnouncementHandler):
+    """Push the latest announcement as server-sent events
+
+    An event is sent when the stream opens and after every queue change,
+    with the queue version as event id. Clients reconnecting with a
+    Last-Event-ID that is still current only get heartbeats. Like the
+    polled endpoints, it is restricted to hub users if ``authenticate``
+    is set."""
+
+    metrics_name = "stream"
+
+    authenticate = False
+
+    # Open streams in this process
+    subscribers = 0
+
+    def initialize(
+        self,
+        queue,
+        allow_origin,
+        heartbeat_interval,
+        max_subscribers,
+        authenticate=False,
+    ):
+        super().initialize(queue)
+        self.allow_origin = allow_origin
+        self.authenticate = authenticate
+        self.heartbeat_interval = datetime.timedelta(seconds=heartbeat_interval)
+        self.max_subscribers = max_subscribers
+        self._closed = False
+        self._wake = locks.Event()
+
+    async def prepare(self):
+        await super().prepare()
+        if self.authenticate and not self.get_current_user():
+            raise web.HTTPError(403, "Announcements require authentication")
+
+    async def get(self):
+        cls = AnnouncementStreamHandler
+        if self.max_subscribers and cls.subscribers >= self.max_subscribers:
+            raise web.HTTPError(503, "Too many announcement stream subscribers")
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        # Ask proxies like nginx not to buffer the stream
+        self.set_header("X-Accel-Buffering", "no")
+        if self.allow_origin:
+            self.add_header("Access-Control-Allow-Origin", "*")
+        cls.subscribers += 1
+        self.queue.add_listener(self._wake.set)
+        try:
+            await self._stream(self.request.headers.get("Last-Event-ID"))
+        except StreamClosedError:
+            pass
+        finally:
+            self.queue.remove_listener(self._wake.set)
+            cls.subscribers -= 1
+
+    async def _stream(self, last_event_id):
+        while not self._closed:
+            if last_event_id != self.queue.version:
+                last_event_id = self.queue.version
+                self.write(self.queue.event_payload())
+            await self.flush()
+            try:
+                await self._wake.wait(timeout=self.heartbeat_interval)
+            except gen.TimeoutError:
+                self.write(b":\n\n")
+            self._wake.clear()
+
+    def on_connection_close(self):
+        self._closed = True
+        self._wake.set()
+
+
+class AnnouncementWebSocketHandler(HubOAuthenticated, websocket.WebSocketHandler):
+    """Push the latest announcement to websocket clients
+
+    Messages have the same JSON content as the latest endpoint and are
+    sent on connect and after queue changes. Anything clients send is
+    ignored. With ``authenticate`` set only hub users may connect."""
+
+    hub_auth_class = CachedHubOAuth
+
+    def initialize(self, broadcast, allow_origin, authenticate=False):
+        super().initialize()
+        self.broadcast = broadcast
+        self.allow_origin = allow_origin
+        self.authenticate = authenticate
+
+    async def prepare(self):
+        if self.authenticate:
+            # Resolved on the event loop here, get_current_user would block it
+            await self.hub_auth.get_user(self, sync=False)
+            if not self.get_current_user():
+                raise web.HTTPError(403, "Announcements require authentication")
+        if self.broadcast.full():
+            raise web.HTTPError(503, "Too many announcement websocket subscribers")
+
+    def check_origin(self, origin):
+        return self.allow_origin or super().check_origin(origin)
+
+    def open(self):
+        self.broadcast.subscribe(self)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        self.broadcast.unsubscribe(self)
+
+
+class AnnouncementBroadcastStatsHandler(AnnouncementHandler):
+    """Return websocket broadcast statistics as JSON"""
+
+    metrics_name = "ws_stats"
+
+    def initialize(self, queue, broadcast):
+        super().initialize(queue)
+        self.broadcast = broadcast
+
+    @web.authenticated
+    def get(self):
+        user = self.get_current_user()
+        if not user["admin"]:
+            raise web.HTTPError(
+                403, f"{user['name']} is not authorized to view broadcast statistics"
+            )
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(json.dumps(self.broadcast.stats()))
+
+
+class AnnouncementChangesHandler(AnnouncementOutputHandler):
+    """Return announcements added and removed since a queue revision as JSON
+
+    Clients pass the ``revision`` of their last response as ``since``.
+    Without it, or if it is too old, the response resets them to the
+    whole queue."""
+
+    metrics_name = "changes"
+
+    def initialize(self, queue, allow_origin, authenticate=False):
+        super().initialize(queue)
+        self.allow_origin = allow_origin
+        self.authenticate = authenticate
+
+    async def get(self):
+        since = self.get_argument("since", None)
+        keys = self.audience()
+        self.write_payload(self.queue.changes_payload(since, keys), keys=keys)
+
+
 class AnnouncementListHandler(AnnouncementOutputHandler):
-    """Return the latest announcement as JSON"""
+    """Return a page of announcements as JSON
 
-    def initialize(self, queue, allow_origin, default_limit=5):
+    Without cursors these are the latest ``limit`` announcements. Passing
+    an announcement id as ``before`` pages back through older ones, and
+    passing one as ``after`` returns those newer than it, oldest first.
+    When the page is full a Link header points to the next one. With
+    ``unread_only`` set only announcements the current user hasn't read
+    are listed."""
+
+    metrics_name = "list"
+
+    def initialize(
+        self, queue, allow_origin, default_limit=5, max_limit=100, authenticate=False
+    ):
         super().initialize(queue)
         self.allow_origin = allow_origin
+        self.authenticate = authenticate
         self.default_limit = default_limit
+        self.max_limit = max_limit
+
+    async def prepare(self):
+        await super().prepare()
+        unread_only = self.get_argument("unread_only", "")
+        self.unread_only = unread_only not in ("", "0", "false")
+        if self.unread_only:
+            await self.resolve_user()
+            if not self.get_current_user():
+                raise web.HTTPError(403, "Unread announcements require authentication")
+
+    def get_int_argument(self, name, default=None):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise web.HTTPError(400, f"{name} must be an integer")
+        if value < 0:
+            raise web.HTTPError(400, f"{name} must not be negative")
+        return value
 
     async def get(self):
-        output = []
-        limit = int(self.get_argument("limit", self.default_limit))
-        if self.queue.announcements:
-            output = [dict(a) for a in self.queue.announcements[-limit:]]
-        self.write_output(output)
+        limit = self.get_int_argument("limit", self.default_limit)
+        if limit == 0:
+            raise web.HTTPError(400, "limit must be positive")
+        limit = min(limit, self.max_limit)
+        before = self.get_int_argument("before")
+        after = self.get_int_argument("after")
+        keys = self.audience()
+        if self.unread_only:
+            user = self.get_current_user()["name"]
+            page = self.queue.unread_page(user, limit, before, after, keys)
+        else:
+            page = await self.queue.list_page(limit, before, after, keys)
+        if page.count == limit:
+            if after is None:
+                cursor = dict(before=page.first)
+            else:
+                cursor = dict(after=page.last)
+                if before is not None:
+                    cursor.update(before=before)
+            if self.unread_only:
+                cursor.update(unread_only=1)
+            url = url_concat(self.request.path, dict(cursor, limit=limit))
+            self.set_header("Link", f'<{url}>; rel="next"')
+        if self.unread_only:
+            # Read state changes without the queue revision changing
+            self.set_header("Cache-Control", "private, no-store")
+            self.write_payload(page.payload, conditional=False)
+        else:
+            self.write_payload(page.payload, keys=keys)
+
+
+class AnnouncementReadHandler(AnnouncementHandler):
+    """Mark announcements read by the current user
+
+    The body is a JSON object or form with a list of announcement ``ids``,
+    or ``all`` set to mark every announcement read."""
+
+    metrics_name = "read"
+
+    def get_read_arguments(self):
+        """Return the announcement ids and whether to mark all of them"""
+        content_type = self.request.headers.get("Content-Type", "")
+        if content_type.split(";")[0].strip() == "application/json":
+            try:
+                body = json.loads(self.request.body or b"{}")
+                ids = body.get("ids", [])
+                mark_all = body.get("all", False)
+            except (ValueError, AttributeError):
+                raise web.HTTPError(400, "Body must be a JSON object")
+            if not isinstance(mark_all, bool):
+                raise web.HTTPError(400, "all must be true or false")
+        else:
+            ids = " ".join(self.get_body_arguments("ids")).replace(",", " ").split()
+            value = self.get_body_argument("all", "")
+            if value not in ("", "0", "false", "1", "true"):
+                raise web.HTTPError(400, "all must be true or false")
+            mark_all = value in ("1", "true")
+        try:
+            ids = [int(i) for i in ids]
+        except (TypeError, ValueError):
+            raise web.HTTPError(400, "ids must be a list of integers")
+        return ids, mark_all
+
+    @web.authenticated
+    async def post(self):
+        user = self.get_current_user()
+        ids, mark_all = self.get_read_arguments()
+        await self.queue.mark_read(user["name"], ids, all=mark_all)
+        self.set_status(204)
 
 
 class AnnouncementUpdateHandler(AnnouncementHandler):
     """Update announcements page"""
 
+    metrics_name = "update"
+
     hub_users = []
     allow_admin = True
 
+    def initialize(self, queue, sanitizer, max_size, executor_size):
+        super().initialize(queue)
+        self.sanitizer = sanitizer
+        self.max_size = max_size
+        self.executor_size = executor_size
+
+    def get_datetime_argument(self, name):
+        """Return an ISO 8601 body argument as naive local time, if given"""
+        value = self.get_body_argument(name, "")
+        if not value:
+            return None
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise web.HTTPError(400, f"{name} must be an ISO 8601 date and time")
+        if value.tzinfo is not None:
+            value = value.astimezone().replace(tzinfo=None)
+        return value
+
+    def get_list_argument(self, name):
+        """Return a comma or whitespace separated body argument as a list"""
+        return self.get_body_argument(name, "").replace(",", " ").split()
+
     @web.authenticated
     async def post(self):
         """Update announcement"""
@@ -120,7 +540,59 @@ class AnnouncementUpdateHandler(AnnouncementHandler):
             raise web.HTTPError(
                 403, f"{user['name']} is not authorized to update announcement"
             )
-        sanitizer = Sanitizer()
-        announcement = sanitizer.sanitize(self.get_body_argument("announcement"))
-        await self.queue.update(user["name"], announcement)
+        announcement = self.get_body_argument("announcement")
+        if self.max_size and len(announcement) > self.max_size:
+            raise web.HTTPError(
+                413, f"Announcement is longer than {self.max_size} characters"
+            )
+        if len(announcement) > self.executor_size:
+            # Keep the event loop serving other requests meanwhile
+            announcement = await ioloop.IOLoop.current().run_in_executor(
+                None, self.sanitizer.sanitize, announcement
+            )
+        else:
+            announcement = self.sanitizer.sanitize(announcement)
+        starts_at = self.get_datetime_argument("starts_at")
+        expires_at = self.get_datetime_argument("expires_at")
+        now = datetime.datetime.now()
+        if expires_at is not None and expires_at <= max(starts_at or now, now):
+            raise web.HTTPError(400, "expires_at must be after now and starts_at")
+        audience = {
+            field: self.get_list_argument(field)
+            for field in ("users", "groups", "scopes")
+        }
+        await self.queue.update(
+            user["name"],
+            announcement,
+            expires_at=expires_at,
+            starts_at=starts_at,
+            audience=audience,
+        )
         self.redirect(self.application.reverse_url("view"))
+
+
+class AnnouncementMetricsHandler(AnnouncementHandler):
+    """Return Prometheus metrics
+
+    Unless authentication is turned off, only admins and holders of one
+    of ``scopes`` may read them, typically through an API token."""
+
+    metrics_name = "metrics"
+
+    def initialize(self, queue, registry, authenticate, scopes):
+        super().initialize(queue)
+        self.registry = registry
+        self.authenticate = authenticate
+        self.scopes = scopes
+
+    def get(self):
+        if self.authenticate:
+            user = self.get_current_user()
+            if user is None:
+                raise web.HTTPError(403, "Reading metrics requires authentication")
+            if not (user["admin"] or self.hub_auth.check_scopes(self.scopes, user)):
+                raise web.HTTPError(
+                    403, f"{user['name']} is not authorized to read metrics"
+                )
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.write(generate_latest(self.registry))
@@ -0,0 +1,202 @@
+"""Prometheus metrics exported by the announcement service
+
+Latencies are recorded into histograms as they happen. Counts kept by
+the queue, the persister and other components anyway are only read when
+metrics are scraped, so they cost nothing on the request path.
+"""
+
+from prometheus_client import CollectorRegistry, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+REQUEST_DURATION_SECONDS = Histogram(
+    "announcement_request_duration_seconds",
+    "Request duration by handler and status code",
+    ["handler", "code"],
+    registry=None,
+)
+
+RESPONSE_SIZE_BYTES = Histogram(
+    "announcement_response_size_bytes",
+    "Response body size by handler",
+    ["handler"],
+    buckets=(128, 512, 2048, 8192, 32768, 131072, 524288, 2097152, float("inf")),
+    registry=None,
+)
+
+PERSIST_DURATION_SECONDS = Histogram(
+    "announcement_persist_duration_seconds",
+    "Duration of writing a batch of queue changes to storage",
+    ["status"],
+    registry=None,
+)
+
+PURGE_DURATION_SECONDS = Histogram(
+    "announcement_purge_duration_seconds",
+    "Duration of purging expired announcements",
+    registry=None,
+)
+
+EXTRA_INFO_DURATION_SECONDS = Histogram(
+    "announcement_extra_info_duration_seconds",
+    "Duration of extra_info_hook calls",
+    ["status"],
+    registry=None,
+)
+
+HISTOGRAMS = (
+    REQUEST_DURATION_SECONDS,
+    RESPONSE_SIZE_BYTES,
+    PERSIST_DURATION_SECONDS,
+    PURGE_DURATION_SECONDS,
+    EXTRA_INFO_DURATION_SECONDS,
+)
+
+# Handler name to status code to (duration, size) histogram children,
+# looked up instead of calling labels() for every request
+_children = {}
+
+
+def observe_request(handler):
+    """Record duration and response size of a finished request"""
+    name = handler.metrics_name
+    status = handler.get_status()
+    try:
+        duration, size = _children[name][status]
+    except KeyError:
+        duration = REQUEST_DURATION_SECONDS.labels(name, str(status))
+        size = RESPONSE_SIZE_BYTES.labels(name)
+        _children.setdefault(name, {})[status] = (duration, size)
+    duration.observe(handler.request.request_time())
+    # Set when the response is finished, after any compression
+    length = handler._headers.get("Content-Length")
+    if length is not None:
+        size.observe(int(length))
+
+
+class ServiceCollector:
+    """Read counts and sizes from the service components at scrape time"""
+
+    def __init__(
+        self, queue, broadcast, stream_handler, extra_info=None, user_cache=None
+    ):
+        self.queue = queue
+        self.broadcast = broadcast
+        self.stream_handler = stream_handler
+        self.extra_info = extra_info
+        self.user_cache = user_cache
+
+    def collect(self):
+        queue = self.queue.stats()
+        yield gauge("queue_length", "Announcements in the queue", queue["length"])
+        yield gauge(
+            "queue_scheduled",
+            "Announcements waiting for their start",
+            queue["scheduled"],
+        )
+        yield gauge(
+            "read_states",
+            "Users with announcements marked read",
+            queue["read_states"],
+        )
+        yield counter(
+            "payload_cache_requests",
+            "Payload cache lookups by result",
+            [(("hit",), queue["cache_hits"]), (("miss",), queue["cache_misses"])],
+            ["result"],
+        )
+
+        if self.queue.persist_path:
+            yield from self.collect_persister(self.queue.persister.stats())
+        yield from self.collect_subscribers()
+        if self.extra_info is not None:
+            yield from self.collect_extra_info(self.extra_info.stats())
+        if self.user_cache is not None:
+            yield from self.collect_user_cache(self.user_cache.stats())
+
+    def collect_persister(self, persister):
+        yield counter(
+            "persist_writes", "Batches written to storage", persister["writes"]
+        )
+        yield counter(
+            "persist_changes", "Queue changes written to storage", persister["changes"]
+        )
+        yield counter(
+            "persist_failures",
+            "Batches that failed to be written to storage",
+            persister["failures"],
+        )
+        yield gauge(
+            "persist_pending",
+            "Queue changes waiting to be written to storage",
+            persister["pending"],
+        )
+
+    def collect_subscribers(self):
+        yield gauge(
+            "stream_subscribers",
+            "Open server-sent event streams",
+            self.stream_handler.subscribers,
+        )
+        broadcast = self.broadcast.stats()
+        yield gauge(
+            "websocket_subscribers",
+            "Open websocket connections",
+            broadcast["subscribers"],
+        )
+        yield counter(
+            "websocket_messages",
+            "Websocket messages by outcome",
+            [
+                (("sent",), broadcast["sent"]),
+                (("dropped",), broadcast["dropped"]),
+            ],
+            ["outcome"],
+        )
+
+    def collect_extra_info(self, extra_info):
+        yield counter(
+            "extra_info_cache_requests",
+            "extra_info_hook cache lookups by result",
+            [(("hit",), extra_info["hits"]), (("miss",), extra_info["misses"])],
+            ["result"],
+        )
+        yield counter(
+            "extra_info_timeouts",
+            "Requests that timed out waiting for extra_info_hook",
+            extra_info["timeouts"],
+        )
+
+    def collect_user_cache(self, user_cache):
+        yield counter(
+            "user_cache_requests",
+            "Hub user lookups by result",
+            [
+                (("hit",), user_cache["hits"]),
+                (("miss",), user_cache["misses"]),
+                (("coalesced",), user_cache["coalesced"]),
+            ],
+            ["result"],
+        )
+        yield gauge("user_cache_entries", "Cached hub users", user_cache["entries"])
+
+
+def gauge(name, documentation, value):
+    return GaugeMetricFamily(f"announcement_{name}", documentation, value=value)
+
+
+def counter(name, documentation, value, labels=None):
+    """Return a counter family with one value, or (label values, value) pairs"""
+    if labels is None:
+        return CounterMetricFamily(f"announcement_{name}", documentation, value=value)
+    family = CounterMetricFamily(f"announcement_{name}", documentation, labels=labels)
+    for label_values, sample in value:
+        family.add_metric(label_values, sample)
+    return family
+
+
+def make_registry(*collectors):
+    """Return a registry of the histograms and ``collectors``"""
+    registry = CollectorRegistry()
+    for collector in HISTOGRAMS + collectors:
+        registry.register(collector)
+    return registry
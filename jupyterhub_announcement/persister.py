@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+from traitlets import Float
+from traitlets.config import LoggingConfigurable
+
+from jupyterhub_announcement.metrics import PERSIST_DURATION_SECONDS
+
+
+class Persister(LoggingConfigurable):
+    """Persist queue changes in the background
+
+    Changes are collected for ``delay`` seconds and then written as one
+    batch by the storage, so a burst of updates costs one write. Batches
+    are written one at a time and in order. Each submitted change gets a
+    future that resolves once it is on disk, to True, or to False if
+    writing it failed. The batch after a failed one carries its changes
+    again, and unless the storage is shared also saves the whole queue,
+    so nothing is lost with the failure. A shared storage is never saved
+    whole, that would overwrite what other processes wrote meanwhile."""
+
+    delay = Float(
+        0.05,
+        help="Seconds to collect further queue changes before persisting them",
+    ).tag(config=True)
+
+    def __init__(self, storage, state, **kwargs):
+        super().__init__(**kwargs)
+        self.storage = storage
+        # Returns the announcements to persist as of the last change
+        self.state = state
+        self._pending = []
+        self._task = None
+        # Changes of failed batches, to be written with the next one
+        self._failed = []
+        self.writes = 0
+        self.changes = 0
+        self.failures = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+
+    def stats(self):
+        return dict(
+            writes=self.writes,
+            changes=self.changes,
+            coalesced=self.changes - self.writes,
+            failures=self.failures,
+            pending=len(self._pending),
+            last_latency=self.last_latency,
+            max_latency=self.max_latency,
+        )
+
+    @property
+    def busy(self):
+        """Whether changes are waiting to be written or being written"""
+        return self._task is not None
+
+    def submit(self, change):
+        """Queue ``change`` for writing and return its durability future"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((change, future))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return future
+
+    async def flush(self):
+        """Wait until all submitted changes are written"""
+        while self._task is not None:
+            await asyncio.shield(self._task)
+
+    async def _run(self):
+        try:
+            while self._pending:
+                await asyncio.sleep(self.delay)
+                batch, self._pending = self._pending, []
+                await self._write(batch)
+        finally:
+            self._task = None
+
+    async def _write(self, batch):
+        # The state must match the last change of the batch, so it is taken
+        # before anything else can change the queue, and copied as storage
+        # may read it on another thread
+        announcements = list(self.state())
+        changes = self._failed + [change for change, _ in batch]
+        if self._failed and not self.storage.shared and ("save", None) not in changes:
+            changes.insert(0, ("save", None))
+        start = time.monotonic()
+        try:
+            await self.storage.apply(changes, announcements)
+        except Exception as err:
+            self.failures += 1
+            self.log.error(f"failed to persist queue ({err})")
+            written = False
+        else:
+            written = True
+        self._failed = [] if written else changes
+        latency = time.monotonic() - start
+        PERSIST_DURATION_SECONDS.labels("success" if written else "failure").observe(
+            latency
+        )
+        self.writes += 1
+        self.changes += len(batch)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        if written:
+            self.log.info(
+                f"persisted {len(batch)} changes to {self.storage.path} "
+                f"in {1000 * latency:.1f}ms"
+            )
+        for _, future in batch:
+            if not future.done():
+                future.set_result(written)
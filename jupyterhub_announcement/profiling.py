@@ -0,0 +1,105 @@
+import cProfile
+import os
+import signal
+import time
+import tracemalloc
+
+from tornado import ioloop
+from traitlets import Bool, Integer, Unicode
+from traitlets.config import LoggingConfigurable
+
+
+class Profiler(LoggingConfigurable):
+    """Profile a running service on demand
+
+    Profiling is toggled by sending the process ``signal``, or started
+    with the service when ``enabled`` is set. Stopping it writes the
+    cProfile stats, and the tracemalloc snapshot if ``trace_memory`` is
+    set, to ``output_dir``. Every worker process profiles itself and
+    writes its own files."""
+
+    enabled = Bool(
+        False,
+        help="Start profiling when the service starts",
+    ).tag(config=True)
+
+    signal = Unicode(
+        "",
+        help="""Name of a signal toggling profiling, like SIGUSR2.
+
+        Sending it once starts profiling, sending it again stops profiling
+        and writes the results. Empty means profiling can't be toggled.""",
+    ).tag(config=True)
+
+    output_dir = Unicode(
+        ".",
+        help="Directory for profiling results",
+    ).tag(config=True)
+
+    trace_memory = Bool(
+        True,
+        help="Trace memory allocations with tracemalloc along with profiling",
+    ).tag(config=True)
+
+    trace_frames = Integer(
+        1,
+        help="Number of frames tracemalloc keeps per allocation",
+    ).tag(config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._profile = None
+        self._started = None
+        # Whether tracemalloc was started here, and is to be stopped here
+        self._tracing = False
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def install(self):
+        """Start profiling if enabled and listen for the toggle signal"""
+        if self.signal:
+            signum = getattr(signal, self.signal)
+            ioloop.IOLoop.current().asyncio_loop.add_signal_handler(signum, self.toggle)
+            self.log.info(f"{self.signal} toggles profiling")
+        if self.enabled:
+            self.start()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.running:
+            return
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+            self._tracing = True
+        self._started = time.strftime("%Y%m%d-%H%M%S")
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self.log.info("profiling started")
+
+    def stop(self):
+        """Stop profiling and return the paths of the files written"""
+        if not self.running:
+            return []
+        self._profile.disable()
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(
+            self.output_dir, f"announcement-{os.getpid()}-{self._started}"
+        )
+        paths = [f"{prefix}.prof"]
+        self._profile.dump_stats(paths[0])
+        self._profile = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            paths.append(f"{prefix}.tracemalloc")
+            tracemalloc.take_snapshot().dump(paths[1])
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        self.log.info(f"profiling stopped, results in {', '.join(paths)}")
+        return paths
@@ -1,20 +1,71 @@
+import asyncio
 import datetime
+import hashlib
+import heapq
 import json
+import secrets
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
 
-import aiofiles
-from traitlets import Float, List, Unicode
+from tornado import escape, ioloop, locks
+from traitlets import Float, Integer, List, Type, Unicode, observe
 from traitlets.config import LoggingConfigurable
 
 from jupyterhub_announcement.encoder import _JSONEncoder
+from jupyterhub_announcement.metrics import PURGE_DURATION_SECONDS
+from jupyterhub_announcement.persister import Persister
+from jupyterhub_announcement.read_state import ReadState
+from jupyterhub_announcement.storage import AnnouncementStorage, JSONFileStorage
 
 
-def _datetime_hook(json_dict):
-    for (key, value) in json_dict.items():
-        try:
-            json_dict[key] = datetime.datetime.fromisoformat(value)
-        except Exception:
-            pass
-    return json_dict
+# Upper bound on the number of distinct encoded payloads kept between changes
+_PAYLOAD_CACHE_SIZE = 32
+
+# Upper bound on the number of audiences whose views are kept between
+# changes, and the cache keys of these views
+_AUDIENCE_CACHE_SIZE = 128
+_AUDIENCE_VIEWS = ("visible", "ids", "etag", "latest")
+
+# Seconds between purges of history kept in storage outside the window
+_HISTORY_PURGE_INTERVAL = 300
+
+# Encoded page of announcements, with its length and first and last ids
+Page = namedtuple("Page", ["payload", "count", "first", "last"])
+
+# Fields of an announcement audience and the kind of their index keys
+_AUDIENCE_KINDS = {"users": "user", "groups": "group", "scopes": "scope"}
+
+
+def audience_keys(user):
+    """Return the audience index keys matching a hub user model
+
+    Keys are ``(kind, value)`` tuples for the user name, groups and
+    scopes. Anonymous users, ``user`` None, match none."""
+    if not user:
+        return frozenset()
+    keys = [("user", user["name"])]
+    keys.extend(("group", group) for group in user.get("groups") or ())
+    keys.extend(("scope", scope) for scope in user.get("scopes") or ())
+    return frozenset(keys)
+
+
+def targets(announcement):
+    """Return the audience index keys of ``announcement``, none for everyone"""
+    audience = announcement.get("audience")
+    if not audience:
+        return []
+    return [
+        (kind, value)
+        for field, kind in _AUDIENCE_KINDS.items()
+        for value in audience.get(field, ())
+    ]
+
+
+def shows(announcement, keys):
+    """Return whether ``announcement`` is shown to users matching ``keys``"""
+    announcement_targets = targets(announcement)
+    return not announcement_targets or not keys.isdisjoint(announcement_targets)
 
 
 class AnnouncementQueue(LoggingConfigurable):
@@ -27,33 +78,99 @@ class AnnouncementQueue(LoggingConfigurable):
 
         For a persistent announcement queue, this parameter must be set to
         a non-empty value and correspond to a read+write-accessible path.
-        The announcement queue is stored as a list of JSON objects. If this
-        parameter is set to a non-empty value:
+        The announcement queue is stored as JSON objects, together with
+        the version of their schema. If this parameter is set to a
+        non-empty value:
 
         * The persistence file is used to initialize the announcement queue
           at start-up. This is the only time the persistence file is read.
         * If the persistence file does not exist at start-up, it is
           created when an announcement is added to the queue.
-        * The persistence file is over-written with the contents of the
-          announcement queue each time a new announcement is added.
+        * The persistence file is updated by the storage_class each time
+          the announcement queue changes; the default storage over-writes
+          it with the contents of the queue.
 
         If this parameter is set to an empty value (the default) then the
         queue is just empty at initialization and the queue is ephemeral;
         announcements will not be persisted on updates to the queue.""",
     ).tag(config=True)
 
+    storage_class = Type(
+        JSONFileStorage,
+        klass=AnnouncementStorage,
+        help="""Class persisting the queue to persist_path.
+
+        The default JSONFileStorage rewrites a JSON list of announcements
+        on every change. JournalStorage appends one JSON line per change
+        instead and compacts the file from time to time, which keeps
+        updates cheap with a long history.""",
+    ).tag(config=True)
+
+    refresh_interval = Float(
+        1.0,
+        help="""Seconds between checks for changes by other processes.
+
+        Only used when the storage_class can be shared between processes,
+        like SQLiteStorage. Every service replica using the same database
+        then reloads the queue within this many seconds of a change made by
+        another one. Zero disables the checks.""",
+    ).tag(config=True)
+
     lifetime_days = Float(
         7.0,
         help="""Number of days to retain announcements.
 
         Announcements that have been in the queue for this many days are
-        purged from the queue.""",
+        purged from the queue, or earlier if they have an expires_at time.""",
+    ).tag(config=True)
+
+    max_changes = Integer(
+        1000,
+        help="""Number of queue changes remembered for the changes endpoint.
+
+        Clients asking for changes since an older revision get the whole
+        queue instead.""",
     ).tag(config=True)
 
     def __init__(self, **kwargs):
+        # Revisions restart with the process, the epoch keeps validators unique
+        self._epoch = secrets.token_hex(4)
+        self._listeners = set()
+        self._lock = locks.Lock()
+        self.revision = 0
+        self._last_id = 0
+        # Ids of the announcements as of the last change, and what changed
+        self._known = set()
+        self._changes = deque()
+        # Number of recent announcements kept in memory, if not all of them
+        self._window = 0
+        # Heap of (expiry, id), with entries of removed announcements left
+        # in place until they come up
+        self._expiry = []
+        # Scheduled announcements by id, held back until their start time,
+        # and a heap of (starts_at, id) for them
+        self._pending = {}
+        self._starts = []
+        self._expiring = False
+        self._timer = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.read_state = ReadState()
+        self.last_modified = None
+        self._stamp()
         super().__init__(**kwargs)
+        self._changes = deque(self._changes, maxlen=self.max_changes)
 
         if self.persist_path:
+            self.storage = self.storage_class(
+                parent=self, log=self.log, path=self.persist_path
+            )
+            self._window = self.storage.window
+            self.persister = Persister(
+                self.storage, self._stored, parent=self, log=self.log
+            )
+            # Shares the dict of storage, also if there is nothing to restore
+            self.read_state = ReadState(self.storage.read_state)
             self.log.info(f"restoring queue from {self.persist_path}")
             self._handle_restore()
         else:
@@ -63,6 +180,425 @@ class AnnouncementQueue(LoggingConfigurable):
     def __len__(self):
         return len(self.announcements)
 
+    def stats(self):
+        return dict(
+            length=len(self.announcements),
+            scheduled=len(self._pending),
+            revision=self.revision,
+            cache_hits=self.cache_hits,
+            cache_misses=self.cache_misses,
+            read_states=len(self.read_state),
+        )
+
+    @observe("announcements")
+    def _announcements_changed(self, change):
+        self._changed()
+        self._schedule_all()
+
+    @observe("lifetime_days")
+    def _lifetime_days_changed(self, change):
+        self._schedule_all()
+
+    def _changed(self, added=None, removed=(), dropped=()):
+        """Bump the revision and drop encoded payloads of the previous one
+
+        Changes passing the ``added`` announcements, the ``removed`` ids and
+        the ids ``dropped`` from a full in-memory window are logged without
+        looking at the whole queue."""
+        self.revision += 1
+        self._stamp()
+        self._log_change(added, removed, dropped)
+        for listener in list(self._listeners):
+            try:
+                listener()
+            except Exception as err:
+                self.log.error(f"queue listener failed ({err})")
+
+    def reseed(self):
+        """Start a new epoch of validators
+
+        Processes forked from the one that made the queue count revisions
+        on their own, the same version must not name different payloads
+        in two of them."""
+        self._epoch = secrets.token_hex(4)
+        self._stamp()
+
+    def _stamp(self):
+        self.version = f"{self._epoch}-{self.revision}"
+        self.etag = f'"{self.version}"'
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        if self.last_modified is not None and now <= self.last_modified:
+            # HTTP dates have whole seconds, so changes within one second
+            # still need later dates for If-Modified-Since to see them
+            now = self.last_modified + datetime.timedelta(seconds=1)
+        self.last_modified = now
+        self._payloads = {}
+        # Number of payloads counted against _PAYLOAD_CACHE_SIZE, and the
+        # audiences with views cached
+        self._bounded = 0
+        self._audiences = set()
+
+    def _log_change(self, added=None, removed=(), dropped=()):
+        if added is not None:
+            self._known.update(a["id"] for a in added)
+            self._known.difference_update(removed)
+            self._known.difference_update(dropped)
+            self._changes.append((self.revision, list(added), sorted(removed)))
+            return
+        ids = {a["id"] for a in self.announcements}
+        added = [a for a in self.announcements if a["id"] not in self._known]
+        removed = self._known - ids
+        if self._window and len(ids) >= self._window:
+            # Older announcements may have just left a full in-memory window
+            oldest = min(ids)
+            removed = {i for i in removed if i > oldest}
+        self._changes.append((self.revision, added, sorted(removed)))
+        self._known = ids
+
+    def _since(self, since):
+        """Return the revision in version ``since`` if changes after it are known"""
+        epoch, _, revision = (since or "").rpartition("-")
+        if epoch != self._epoch or not revision.isdigit() or not self._changes:
+            return None
+        revision = int(revision)
+        if self._changes[0][0] - 1 <= revision <= self.revision:
+            return revision
+        return None
+
+    def changes(self, since):
+        """Return what changed after the queue ``version`` given as ``since``
+
+        The result has the current ``revision`` (a queue version), the
+        ``added`` announcements and the ids of ``removed`` ones. If the
+        changes since then are not known anymore ``reset`` is true and
+        ``added`` has the whole queue instead."""
+        return self._changes_since(self._since(since))
+
+    def _changes_since(self, revision, keys=frozenset()):
+        if revision is None:
+            return dict(
+                revision=self.version,
+                reset=True,
+                added=[dict(a) for a in self.visible(keys)],
+                removed=[],
+            )
+        added = {}
+        removed = set()
+        for change_revision, change_added, change_removed in self._changes:
+            if change_revision <= revision:
+                continue
+            added.update((a["id"], a) for a in change_added)
+            removed.update(change_removed)
+        for i in removed:
+            added.pop(i, None)
+        return dict(
+            revision=self.version,
+            reset=False,
+            added=[dict(a) for a in added.values() if shows(a, keys)],
+            removed=sorted(removed),
+        )
+
+    def changes_payload(self, since, keys=frozenset()):
+        """Return changes after the ``since`` version encoded as UTF-8 JSON"""
+        revision = self._since(since)
+        keys = self.shown(keys)
+        return self._cached(
+            self.audience_key(("changes", revision), keys),
+            lambda: self._changes_since(revision, keys),
+        )
+
+    def add_listener(self, listener):
+        """Call ``listener()`` with no arguments after every queue change"""
+        self._listeners.add(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.discard(listener)
+
+    def cached(self, key, build):
+        """Return ``build()``, called once per revision for each ``key``"""
+        try:
+            value = self._payloads[key]
+        except KeyError:
+            pass
+        else:
+            self.cache_hits += 1
+            return value
+        self.cache_misses += 1
+        value = build()
+        self._store(key, value)
+        return value
+
+    def _cached(self, key, build):
+        return self.cached(key, lambda: self._encode(build()))
+
+    def _encode(self, output):
+        return escape.utf8(json.dumps(output, cls=_JSONEncoder))
+
+    def _store(self, key, payload):
+        if key[0] == "audience" and key[2] in _AUDIENCE_VIEWS:
+            # Views of an audience, needed by every request of its users,
+            # don't compete with list pages for cache slots
+            audience = key[1]
+            if audience not in self._audiences:
+                if len(self._audiences) >= _AUDIENCE_CACHE_SIZE:
+                    return
+                self._audiences.add(audience)
+            self._payloads[key] = payload
+            return
+        # List pages, changes since any revision a client sends, their
+        # compressed variants and other payloads for targeted audiences come
+        # in unbounded variety, the few other payloads don't
+        if key[0] in ("list", "changes", "compressed", "audience"):
+            if self._bounded >= _PAYLOAD_CACHE_SIZE:
+                return
+            self._bounded += 1
+        self._payloads[key] = payload
+
+    def audience_key(self, key, keys):
+        """Return the payload cache key ``key`` for an audience"""
+        return ("audience", keys) + key if keys else key
+
+    def index(self):
+        """Return positions in the queue of announcements by audience key
+
+        Announcements for everyone are under None. The index is built
+        once per revision."""
+        # Looked up for every request, kept out of the payload cache counts
+        index = self._payloads.get(("index",))
+        if index is None:
+            index = self._payloads[("index",)] = self._index()
+        return index
+
+    def _index(self):
+        index = {None: []}
+        for position, announcement in enumerate(self.announcements):
+            keys = targets(announcement)
+            if not keys:
+                index[None].append(position)
+            for key in keys:
+                index.setdefault(key, []).append(position)
+        return index
+
+    @property
+    def targeted(self):
+        """Whether any announcement in the queue has an audience"""
+        return len(self.index()) > 1
+
+    def shown(self, keys):
+        """Return the audience ``keys`` some announcement in the queue targets
+
+        Users matching the same ones see the same announcements and share
+        their payloads."""
+        index = self.index()
+        if len(index) == 1:
+            return frozenset()
+        return frozenset(key for key in keys if key in index)
+
+    def visible(self, keys=frozenset()):
+        """Return the announcements shown to users matching audience ``keys``"""
+        index = self.index()
+        if len(index) == 1:
+            return self.announcements
+        keys = self.shown(keys)
+        return self.cached(
+            self.audience_key(("visible",), keys),
+            lambda: self._merge(index, keys),
+        )
+
+    def _merge(self, index, keys):
+        announcements = []
+        last = None
+        for position in heapq.merge(*(index[key] for key in (None, *keys))):
+            # Announcements targeting several of the keys come up repeatedly
+            if position != last:
+                announcements.append(self.announcements[position])
+                last = position
+        return announcements
+
+    def etag_for(self, keys):
+        """Return the entity tag of payloads for users matching ``keys``"""
+        keys = self.shown(keys)
+        if not keys:
+            return self.etag
+        return self.cached(
+            self.audience_key(("etag",), keys),
+            lambda: '"%s-%s"'
+            % (
+                self.version,
+                hashlib.sha256(repr(sorted(keys)).encode()).hexdigest()[:16],
+            ),
+        )
+
+    def latest(self, keys=frozenset()):
+        """Return a copy of the latest announcement shown to ``keys``"""
+        announcements = self.visible(keys)
+        if announcements:
+            return dict(announcements[-1])
+        return {"announcement": ""}
+
+    def latest_payload(self, keys=frozenset()):
+        """Return the latest announcement encoded as UTF-8 JSON"""
+        keys = self.shown(keys)
+        return self._cached(
+            self.audience_key(("latest",), keys), lambda: self.latest(keys)
+        )
+
+    def event_payload(self):
+        """Return the latest announcement as a server-sent event"""
+        return self.cached(
+            ("event",),
+            lambda: b"id: %s\ndata: %s\n\n"
+            % (escape.utf8(self.version), self.latest_payload()),
+        )
+
+    async def list_payload(self, limit, before=None, after=None, keys=frozenset()):
+        """Return a page of announcements encoded as UTF-8 JSON"""
+        return (await self.list_page(limit, before, after, keys)).payload
+
+    async def list_page(self, limit, before=None, after=None, keys=frozenset()):
+        """Return a page of announcements encoded as UTF-8 JSON, with its ids"""
+        key = self.audience_key(("list", limit, before, after), self.shown(keys))
+        # Built asynchronously, so not through cached(), but counted the same
+        try:
+            page = self._payloads[key]
+        except KeyError:
+            pass
+        else:
+            self.cache_hits += 1
+            return page
+        self.cache_misses += 1
+        revision = self.revision
+        page = self._page(await self.page(limit, before, after, keys))
+        if revision == self.revision:
+            self._store(key, page)
+        return page
+
+    def _page(self, announcements):
+        return Page(
+            self._encode(announcements),
+            len(announcements),
+            announcements[0]["id"] if announcements else None,
+            announcements[-1]["id"] if announcements else None,
+        )
+
+    async def page(self, limit, before=None, after=None, keys=frozenset()):
+        """Return up to ``limit`` announcements shown to ``keys`` in id order
+
+        With ``after`` the page starts right after that id, otherwise it
+        ends right before ``before`` or with the latest announcement.
+        Announcements older than those kept in memory are read from storage."""
+        announcements = self.visible(keys)
+        ids = self._ids(keys)
+        start = 0 if after is None else bisect_right(ids, after)
+        end = len(ids) if before is None else bisect_left(ids, before)
+        if after is None:
+            start = max(start, end - limit)
+        else:
+            end = min(end, start + limit)
+        full = self._window and len(self.announcements) >= self._window
+        if full and start == 0:
+            # Storage may hold older announcements belonging on this page
+            if after is not None or end < limit:
+                # Storage has to catch up with the queue first
+                await self.flush()
+                return await self._stored_page(limit, before, after, keys)
+        return [dict(a) for a in announcements[start:end]]
+
+    def _ids(self, keys):
+        """Return the ids of the announcements shown to ``keys``, in order"""
+        return self.cached(
+            self.audience_key(("ids",), self.shown(keys)),
+            lambda: [a["id"] for a in self.visible(keys)],
+        )
+
+    def unread_page(self, user, limit, before=None, after=None, keys=frozenset()):
+        """Return a page of unread announcements encoded as UTF-8 JSON"""
+        return self._page(self.unread(user, limit, before, after, keys))
+
+    def unread(self, user, limit, before=None, after=None, keys=frozenset()):
+        """Return a page like page(), of the announcements ``user`` hasn't read
+
+        Only announcements kept in memory are looked at. Pages depend on
+        the read state of the user and are not cached."""
+        announcements = self.visible(keys)
+        ids = self._ids(keys)
+        mark, _ = self.read_state.get(user)
+        # Everything up to the mark is read
+        start = bisect_right(ids, max(mark, after or 0))
+        end = len(ids) if before is None else bisect_left(ids, before)
+        unread = self.read_state.unread(user, announcements[start:end])
+        unread = unread[:limit] if after is not None else unread[-limit:]
+        return [dict(a) for a in unread]
+
+    async def mark_read(self, user, ids=(), all=False):
+        """Mark the announcements with ``ids`` read by ``user``
+
+        With ``all`` every announcement posted so far is marked read.
+        Return a future resolving once the read state is persisted, to
+        whether that worked, or None if nothing changed."""
+        async with self._lock:
+            posted = [a["id"] for a in self.announcements[:1]]
+            # Ids below those of posted and scheduled announcements are gone
+            floor = min(posted + list(self._pending), default=self._last_id + 1) - 1
+            if all:
+                ids = [a["id"] for a in self.announcements]
+            state = self.read_state.mark(user, ids, floor, self._last_id)
+            if state is None:
+                return None
+            return self._persist(("read", (user, state)))
+
+    async def _stored_page(self, limit, before, after, keys):
+        """Return a page from storage, skipping announcements not shown
+
+        Scheduled announcements are stored as well, they are skipped until
+        they start."""
+        announcements = []
+        while len(announcements) < limit:
+            chunk = await self.storage.page(limit, before, after)
+            shown = [a for a in chunk if "starts_at" not in a and shows(a, keys)]
+            if after is None:
+                announcements[:0] = shown
+                if chunk:
+                    before = chunk[0]["id"]
+            else:
+                announcements.extend(shown)
+                if chunk:
+                    after = chunk[-1]["id"]
+            if len(chunk) < limit:
+                break
+        if after is None:
+            return announcements[-limit:]
+        return announcements[:limit]
+
+    @property
+    def shared(self):
+        """Whether other processes may change the persisted queue"""
+        return bool(self.persist_path) and self.storage.shared
+
+    async def refresh(self):
+        """Reload the queue if another process changed its storage"""
+        try:
+            if self.persister.busy:
+                # Reloading now could drop changes not written yet
+                return
+            if await self.storage.read_changed():
+                self.read_state = ReadState(await self.storage.reload_read_state())
+            if not await self.storage.changed():
+                return
+            async with self._lock:
+                announcements = await self.storage.reload()
+                # Other processes posted announcements with higher ids
+                self._last_id = max(self._last_id, self.storage.last_id)
+                self.read_state = ReadState(self.storage.read_state)
+                if not self._load(announcements):
+                    # History outside the in-memory window or scheduled
+                    # announcements changed
+                    self._changed()
+        except Exception as err:
+            self.log.error(f"failed to refresh queue ({err})")
+            return
+        self.log.info(f"queue refreshed from {self.persist_path}")
+
     def _handle_restore(self):
         try:
             self._restore()
@@ -72,38 +608,243 @@ class AnnouncementQueue(LoggingConfigurable):
             self.log.error(f"failed to restore queue ({err})")
 
     def _restore(self):
-        with open(self.persist_path) as stream:
-            self.announcements = json.load(stream, object_hook=_datetime_hook)
+        announcements = self.storage.restore()
+        self._last_id = max(
+            [self.storage.last_id] + [a.get("id", 0) for a in announcements]
+        )
+        for a in announcements:
+            if "id" not in a:
+                # Persisted before announcements had ids
+                self._last_id += 1
+                a["id"] = self._last_id
+        self.read_state = ReadState(self.storage.read_state)
+        self._load(announcements)
+
+    def _load(self, announcements):
+        """Set the queue from persisted announcements, holding back scheduled ones
+
+        Return whether the active announcements changed."""
+        self._pending = {a["id"]: a for a in announcements if "starts_at" in a}
+        self._starts = [(a["starts_at"], a["id"]) for a in self._pending.values()]
+        heapq.heapify(self._starts)
+        if self._pending:
+            announcements = [a for a in announcements if "starts_at" not in a]
+        changed = announcements != self.announcements
+        if changed:
+            self.announcements = announcements
+        self._schedule()
+        return changed
+
+    def scheduled(self):
+        """Return copies of the scheduled announcements by start time"""
+        return [
+            dict(self._pending[i])
+            for _, i in sorted(self._starts)
+            if i in self._pending
+        ]
 
-    async def update(self, user, announcement=""):
-        self.announcements.append(
-            dict(
-                user=user, announcement=announcement, timestamp=datetime.datetime.now()
+    def _stored(self):
+        """Return the announcements to persist, scheduled ones included"""
+        if not self._pending:
+            return self.announcements
+        return list(
+            heapq.merge(
+                self.announcements,
+                sorted(self._pending.values(), key=lambda a: a["id"]),
+                key=lambda a: a["id"],
             )
         )
-        if self.persist_path:
-            self.log.info(f"persisting queue to {self.persist_path}")
-            await self._handle_persist()
 
-    async def _handle_persist(self):
-        try:
-            await self._persist()
-        except Exception as err:
-            self.log.error(f"failed to persist queue ({err})")
+    async def _next_id(self):
+        if self.shared:
+            # Other processes allocate ids from the same sequence
+            try:
+                self._last_id = await self.storage.next_id()
+                return self._last_id
+            except Exception as err:
+                self.log.error(f"failed to allocate id from storage ({err})")
+        self._last_id += 1
+        return self._last_id
+
+    async def update(
+        self, user, announcement="", expires_at=None, starts_at=None, audience=None
+    ):
+        """Add an announcement
 
-    async def _persist(self):
-        async with aiofiles.open(self.persist_path, "w") as stream:
-            await stream.write(
-                json.dumps(self.announcements, cls=_JSONEncoder, indent=2)
+        With a future ``starts_at`` the announcement is scheduled. It is
+        held back until then and posted with that time as timestamp. An
+        ``audience`` dict with lists of ``users``, ``groups`` or ``scopes``
+        limits who is shown the announcement to hub users having any of
+        them.
+
+        Return a future resolving once the announcement is persisted, to
+        whether that worked; the update itself doesn't wait for it."""
+        # Changes and their persistence must happen in the same order
+        async with self._lock:
+            entry = dict(
+                id=await self._next_id(),
+                user=user,
+                announcement=announcement,
+                timestamp=datetime.datetime.now(),
             )
+            if expires_at is not None:
+                entry["expires_at"] = expires_at
+            audience = {
+                field: list(values)
+                for field, values in (audience or {}).items()
+                if field in _AUDIENCE_KINDS and values
+            }
+            if audience:
+                entry["audience"] = audience
+            if starts_at is not None and starts_at > entry["timestamp"]:
+                entry.update(timestamp=starts_at, starts_at=starts_at)
+                self._pending[entry["id"]] = entry
+                heapq.heappush(self._starts, (starts_at, entry["id"]))
+            else:
+                dropped = self._post(entry)
+                self._changed([entry], dropped=dropped)
+            self._schedule()
+            return self._persist(("append", entry))
+
+    def _post(self, entry):
+        """Make ``entry`` the latest active announcement
+
+        Return the ids of announcements this pushes out of a full window."""
+        self.announcements.append(entry)
+        dropped = []
+        if self._window and len(self.announcements) > self._window:
+            dropped = [a["id"] for a in self.announcements[: -self._window]]
+            del self.announcements[: -self._window]
+        heapq.heappush(self._expiry, (self.expiry(entry), entry["id"]))
+        return dropped
+
+    async def activate(self):
+        """Post scheduled announcements whose start time has come
+
+        They get new ids on the way, so ids stay in posting order."""
+        now = datetime.datetime.now()
+        async with self._lock:
+            started = []
+            while self._starts and self._starts[0][0] <= now:
+                _, pending_id = heapq.heappop(self._starts)
+                entry = self._pending.pop(pending_id, None)
+                if entry is not None:
+                    started.append(entry)
+            posted = []
+            dropped = []
+            for entry in started:
+                entry = dict(entry, id=await self._next_id())
+                del entry["starts_at"]
+                dropped.extend(self._post(entry))
+                posted.append(entry)
+            if posted:
+                self._changed(posted, dropped=dropped)
+                self._persist(("remove", [entry["id"] for entry in started]))
+                for entry in posted:
+                    self._persist(("append", entry))
+            self._schedule()
+
+    def expiry(self, announcement):
+        """Return when ``announcement`` expires
+
+        That is lifetime_days after it was posted, or its ``expires_at``
+        time if that comes first."""
+        expiry = announcement["timestamp"] + datetime.timedelta(days=self.lifetime_days)
+        expires_at = announcement.get("expires_at")
+        if expires_at is not None:
+            expiry = min(expiry, expires_at)
+        return expiry
+
+    def start_expiry(self):
+        """Post and purge announcements when they start and expire from now on
+
+        One timer is set for the next scheduled start or expiry. History
+        kept in storage outside the in-memory window is purged periodically."""
+        self._expiring = True
+        self._schedule()
+        if self._window:
+            ioloop.PeriodicCallback(self.purge, _HISTORY_PURGE_INTERVAL * 1000).start()
+
+    def _schedule_all(self):
+        self._expiry = [(self.expiry(a), a["id"]) for a in self.announcements]
+        heapq.heapify(self._expiry)
+        self._schedule()
+
+    def _schedule(self):
+        """Set the timer for the next scheduled start or expiry"""
+        if not self._expiring:
+            return
+        while self._expiry and self._expiry[0][1] not in self._known:
+            heapq.heappop(self._expiry)
+        while self._starts and self._starts[0][1] not in self._pending:
+            heapq.heappop(self._starts)
+        loop = ioloop.IOLoop.current()
+        if self._timer is not None:
+            loop.remove_timeout(self._timer)
+            self._timer = None
+        due = [heap[0][0] for heap in (self._expiry, self._starts) if heap]
+        if due:
+            delay = (min(due) - datetime.datetime.now()).total_seconds()
+            self._timer = loop.call_at(loop.time() + max(delay, 0), self._tick)
+
+    async def _tick(self):
+        self._timer = None
+        await self.activate()
+        await self.purge()
+
+    def _persist(self, change):
+        """Hand ``change`` to the persister, returning its durability future"""
+        if not self.persist_path:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(False)
+            return future
+        return self.persister.submit(change)
+
+    async def _handle_persist(self):
+        """Save the whole queue, returning whether that worked"""
+        return await self._persist(("save", None))
+
+    async def flush(self):
+        """Wait until all changes so far are persisted"""
+        if self.persist_path:
+            await self.persister.flush()
 
     async def purge(self):
-        max_age = datetime.timedelta(days=self.lifetime_days)
+        """Remove expired announcements
+
+        Only announcements due according to the expiry heap are looked at,
+        so purging costs little when nothing or little has expired."""
+        start = time.monotonic()
         now = datetime.datetime.now()
-        old_count = len(self.announcements)
-        self.announcements = [
-            a for a in self.announcements if now - a["timestamp"] < max_age
-        ]
-        if self.persist_path and len(self.announcements) < old_count:
-            self.log.info(f"persisting queue to {self.persist_path}")
-            await self._handle_persist()
+        until = now - datetime.timedelta(days=self.lifetime_days)
+        async with self._lock:
+            expired = set()
+            while self._expiry and self._expiry[0][0] <= now:
+                _, announcement_id = heapq.heappop(self._expiry)
+                if announcement_id in self._known:
+                    expired.add(announcement_id)
+            removed = []
+            if expired:
+                announcements = self.announcements
+                count = 0
+                while count < len(expired) and announcements[count]["id"] in expired:
+                    count += 1
+                if count == len(expired):
+                    # Usually the oldest announcements expire first
+                    removed = announcements[:count]
+                    del announcements[:count]
+                else:
+                    removed = [a for a in announcements if a["id"] in expired]
+                    announcements[:] = [
+                        a for a in announcements if a["id"] not in expired
+                    ]
+                self._changed((), [a["id"] for a in removed])
+            # Announcements removed before their lifetime ended
+            early = [a["id"] for a in removed if a["timestamp"] > until]
+            if early:
+                self._persist(("remove", early))
+            # With a window, storage may hold more to purge than memory
+            if len(early) < len(removed) or self._window:
+                self._persist(("purge", until))
+            self._schedule()
+        PURGE_DURATION_SECONDS.observe(time.monotonic() - start)
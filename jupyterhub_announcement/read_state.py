@@ -0,0 +1,71 @@
+class ReadState:
+    """Announcements every user has read or dismissed
+
+    The state of a user is a pair ``(mark, bits)``: every announcement id
+    up to the high-water ``mark`` is read, and bit ``i`` of the integer
+    ``bits`` is set if id ``mark + 1 + i`` is. Read ids right above the
+    mark are folded into it, so for a user reading more or less in order
+    the bitmap stays a few bits long.
+
+    ``states`` maps user names to their state and is used as is, not
+    copied, so storage can persist it directly."""
+
+    def __init__(self, states=None):
+        self.states = {} if states is None else states
+
+    def __len__(self):
+        return len(self.states)
+
+    def get(self, user):
+        return self.states.get(user, (0, 0))
+
+    def is_read(self, user, announcement_id):
+        mark, bits = self.get(user)
+        offset = announcement_id - mark - 1
+        return offset < 0 or bool(bits >> offset & 1)
+
+    def unread(self, user, announcements):
+        """Return the ``announcements`` ``user`` hasn't read, in order"""
+        mark, bits = self.get(user)
+        unread = []
+        for announcement in announcements:
+            offset = announcement["id"] - mark - 1
+            if offset >= 0 and not bits >> offset & 1:
+                unread.append(announcement)
+        return unread
+
+    def mark(self, user, ids, floor=0, last=0):
+        """Mark ``ids`` read by ``user``, return the new state if it changed
+
+        Ids up to ``floor`` are read as well, ``last`` is the highest id
+        mark all of them read. Ids above ``last`` are ignored, ids that
+        don't exist yet would only bloat the bitmap."""
+        state = self.get(user)
+        mark, bits = state
+        if floor > mark:
+            bits >>= floor - mark
+            mark = floor
+        for announcement_id in ids:
+            offset = announcement_id - mark - 1
+            if offset >= 0 and announcement_id <= last:
+                bits |= 1 << offset
+        if bits & 1:
+            # Number of read ids right above the mark
+            run = (bits ^ (bits + 1)).bit_length() - 1
+            bits >>= run
+            mark += run
+        if (mark, bits) == state:
+            return None
+        self.states[user] = (mark, bits)
+        return mark, bits
+
+
+def encode_state(state):
+    """Return a state as JSON, with the bitmap in hexadecimal"""
+    mark, bits = state
+    return [mark, format(bits, "x")]
+
+
+def decode_state(value):
+    mark, bits = value
+    return mark, int(bits, 16)
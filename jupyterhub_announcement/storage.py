@@ -0,0 +1,605 @@
+import asyncio
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import aiofiles
+import aiofiles.os
+from traitlets import Enum, Float, Integer, Unicode
+from traitlets.config import LoggingConfigurable
+
+from jupyterhub_announcement.encoder import dumps, loads
+from jupyterhub_announcement.read_state import decode_state, encode_state
+
+_fsync = aiofiles.os.wrap(os.fsync)
+
+
+# Version of the persisted format, files without one are version 0.
+# Version 2 added read state.
+SCHEMA_VERSION = 2
+
+# Announcement fields holding times, the only ones parsed as datetimes
+DATETIME_FIELDS = ("timestamp", "starts_at", "expires_at")
+
+
+def _decode(announcement):
+    for field in DATETIME_FIELDS:
+        value = announcement.get(field)
+        if value is not None:
+            announcement[field] = datetime.datetime.fromisoformat(value)
+    return announcement
+
+
+def _check_version(version, path):
+    if version > SCHEMA_VERSION:
+        raise ValueError(
+            f"{path} has schema version {version}, "
+            f"this version of the service reads up to {SCHEMA_VERSION}"
+        )
+
+
+def _parse_document(document, path):
+    """Return the announcements in a document written by JSONFileStorage"""
+    if isinstance(document, list):
+        document = dict(version=0, announcements=document)
+    _check_version(document["version"], path)
+    return [_decode(a) for a in document["announcements"]]
+
+
+def _parse_read_state(document):
+    """Return the read state in a document written by JSONFileStorage"""
+    if isinstance(document, list):
+        return {}
+    read_state = document.get("read", {})
+    return {user: decode_state(value) for user, value in read_state.items()}
+
+
+def _write_atomic(path, text):
+    """Replace the file at ``path``, which is never seen partially written"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as stream:
+            stream.write(text)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+_write_atomic_async = aiofiles.os.wrap(_write_atomic)
+
+
+class AnnouncementStorage(LoggingConfigurable):
+    """Base class for persisting the announcement queue
+
+    Subclasses implement ``restore`` and ``save``. The queue reports its
+    changes in batches through ``apply``, which just saves the whole queue
+    unless a subclass can record the changes more cheaply. The queue makes
+    these calls one at a time and in the order of its changes.
+
+    A storage with a non-zero ``window`` holds more history than the queue
+    keeps in memory. Its ``restore`` returns only the ``window`` most recent
+    active announcements along with all scheduled ones, and ``page`` is
+    used to read further back. Pages may include scheduled announcements.
+
+    A ``shared`` storage may be written by several processes at once. It
+    implements ``changed`` to tell whether another process wrote to it
+    since the last ``restore`` or ``reload``, and ``next_id`` to hand out
+    announcement ids.
+
+    ``read_state`` maps user names to the ``(mark, bits)`` state of the
+    announcements they read, see ReadState. ``restore`` sets it, the queue
+    updates it in place and reports updates as changes."""
+
+    path = Unicode(help="Path of the persistence file")
+
+    window = 0
+
+    shared = False
+
+    # Highest announcement id known to have been used, set by restore
+    last_id = 0
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.read_state = {}
+
+    def restore(self):
+        """Return the persisted list of announcements"""
+        raise NotImplementedError()
+
+    async def save(self, announcements):
+        """Persist the whole list of announcements"""
+        raise NotImplementedError()
+
+    async def page(self, limit, before=None, after=None):
+        """Return persisted announcements like AnnouncementQueue.page"""
+        raise NotImplementedError()
+
+    async def next_id(self):
+        """Return a new announcement id"""
+        raise NotImplementedError()
+
+    async def changed(self):
+        """Return whether another process changed the persisted queue"""
+        return False
+
+    async def reload(self):
+        """Restore the persisted list of announcements again"""
+        return self.restore()
+
+    async def read_changed(self):
+        """Return whether another process changed only the read state"""
+        return False
+
+    async def reload_read_state(self):
+        """Set ``read_state`` from storage again and return it"""
+        return self.read_state
+
+    async def apply(self, changes, announcements):
+        """Persist ``changes`` leading to the list ``announcements``
+
+        Changes are tuples, in order, of ``("append", announcement)`` for an
+        announcement added to the end, ``("purge", until)`` for removal of
+        announcements with timestamps up to ``until``, ``("remove", ids)``
+        for removal by id, ``("read", (user, state))`` for a new read state
+        of a user and ``("save", None)`` asking to save everything."""
+        await self.save(announcements)
+
+
+class JSONFileStorage(AnnouncementStorage):
+    """Store the queue as a JSON document, rewritten on every change
+
+    The document has the schema ``version``, the list of ``announcements``
+    and the ``read`` state of users. A bare list, as written by earlier
+    versions, is read as well."""
+
+    def restore(self):
+        with open(self.path) as stream:
+            document = loads(stream.read())
+        announcements = _parse_document(document, self.path)
+        self.read_state = _parse_read_state(document)
+        return announcements
+
+    async def save(self, announcements):
+        document = dict(
+            version=SCHEMA_VERSION,
+            announcements=announcements,
+            read={user: encode_state(s) for user, s in self.read_state.items()},
+        )
+        # Readers never see a partial file, not even after a crash
+        await _write_atomic_async(self.path, dumps(document, indent=True))
+
+
+class JournalStorage(AnnouncementStorage):
+    """Store the queue as an append-only journal of JSON lines
+
+    Each added announcement is one ``add`` record, each purge is one
+    ``purge`` or ``remove`` record and each change of the read state of a
+    user one ``read`` record, so persisting a change costs the same
+    whatever the length of the history. Restoring replays the journal.
+    Once enough records are no longer needed the journal is compacted by
+    writing the live announcements to a temporary file that replaces it.
+
+    A file written by JSONFileStorage is read as well and converted to a
+    journal at start-up."""
+
+    fsync = Enum(
+        ["always", "interval", "never"],
+        "always",
+        help="""When to flush journal writes to disk.
+
+        "always" syncs after every record, "interval" at most once every
+        fsync_interval seconds and "never" leaves it to the operating system.""",
+    ).tag(config=True)
+
+    fsync_interval = Float(
+        1.0,
+        help='Seconds between syncs with fsync = "interval"',
+    ).tag(config=True)
+
+    max_dead_records = Integer(
+        1000,
+        help="""Compact the journal once it has this many records not needed
+        to restore the queue, i.e. purged announcements and purge records.""",
+    ).tag(config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._records = 0
+        self._last_fsync = 0.0
+
+    def restore(self):
+        with open(self.path) as stream:
+            text = stream.read()
+        # Journal records are single lines, JSONFileStorage documents not
+        if text.lstrip().startswith("[") or text.startswith("{\n"):
+            self.log.info(f"converting {self.path} to a journal")
+            document = loads(text)
+            announcements = _parse_document(document, self.path)
+            self.read_state = _parse_read_state(document)
+            self._compact(announcements)
+            return announcements
+
+        announcements = []
+        self.read_state = {}
+        self._records = 0
+        lines = text.splitlines()
+        for number, line in enumerate(lines, 1):
+            try:
+                record = loads(line)
+            except ValueError:
+                if number == len(lines):
+                    # Interrupted while appending, that record never completed
+                    self.log.warning(f"ignoring truncated record in {self.path}")
+                    break
+                raise
+            self._replay(record, announcements)
+            self._records += 1
+        if self._dead(announcements) >= self.max_dead_records:
+            self._compact(announcements)
+        return announcements
+
+    def _replay(self, record, announcements):
+        if record["op"] == "add":
+            announcements.append(_decode(record["announcement"]))
+            self.last_id = max(self.last_id, record["announcement"].get("id", 0))
+        elif record["op"] == "meta":
+            _check_version(record.get("version", 0), self.path)
+            self.last_id = max(self.last_id, record["last_id"])
+        elif record["op"] == "purge":
+            until = datetime.datetime.fromisoformat(record["until"])
+            announcements[:] = [a for a in announcements if a["timestamp"] > until]
+        elif record["op"] == "remove":
+            ids = set(record["ids"])
+            announcements[:] = [a for a in announcements if a.get("id") not in ids]
+        elif record["op"] == "read":
+            self.read_state[record["user"]] = decode_state(record["state"])
+        else:
+            raise ValueError(f"unknown journal record {record['op']!r}")
+
+    def _live(self, announcements):
+        # A compacted journal has one meta record besides the announcements
+        # and the read state of every user
+        return len(announcements) + len(self.read_state) + 1
+
+    def _dead(self, announcements):
+        return self._records - self._live(announcements)
+
+    def _compact(self, announcements):
+        _write_atomic(self.path, self._snapshot(announcements))
+        self._records = self._live(announcements)
+
+    def _snapshot(self, announcements):
+        # Ids of purged announcements must not be handed out again
+        self.last_id = max([self.last_id] + [a.get("id", 0) for a in announcements])
+        meta = dict(op="meta", version=SCHEMA_VERSION, last_id=self.last_id)
+        return (
+            self._encode(meta)
+            + "".join(
+                self._encode(dict(op="add", announcement=a)) for a in announcements
+            )
+            + "".join(
+                self._encode(dict(op="read", user=user, state=encode_state(state)))
+                for user, state in self.read_state.items()
+            )
+        )
+
+    def _encode(self, record):
+        return dumps(record) + "\n"
+
+    async def _write(self, records):
+        async with aiofiles.open(self.path, "a") as stream:
+            await stream.write("".join(self._encode(record) for record in records))
+            await stream.flush()
+            if self._should_fsync():
+                await _fsync(stream.fileno())
+        self._records += len(records)
+
+    def _should_fsync(self):
+        if self.fsync == "always":
+            return True
+        if self.fsync == "interval":
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                self._last_fsync = now
+                return True
+        return False
+
+    async def _maybe_compact(self, announcements):
+        if self._dead(announcements) < self.max_dead_records:
+            return
+        self.log.info(f"compacting journal {self.path}")
+        await self.save(announcements)
+
+    async def save(self, announcements):
+        await _write_atomic_async(self.path, self._snapshot(announcements))
+        self._records = self._live(announcements)
+
+    async def apply(self, changes, announcements):
+        if any(op == "save" for op, _ in changes):
+            await self.save(announcements)
+            return
+        records = []
+        for op, value in changes:
+            if op == "append":
+                self.last_id = max(self.last_id, value["id"])
+                records.append(dict(op="add", announcement=value))
+            elif op == "purge":
+                records.append(dict(op="purge", until=value))
+            elif op == "remove":
+                records.append(dict(op="remove", ids=value))
+            elif op == "read":
+                user, state = value
+                records.append(dict(op="read", user=user, state=encode_state(state)))
+            else:
+                raise ValueError(f"unknown change {op!r}")
+        # One write and sync for the whole batch
+        await self._write(records)
+        await self._maybe_compact(announcements)
+
+
+class SQLiteStorage(AnnouncementStorage):
+    """Store the queue in a SQLite database indexed on timestamp
+
+    The full history stays in the database and only the ``window`` most
+    recent announcements are loaded into memory. Reading further back,
+    appending and purging are indexed queries, run on a dedicated thread
+    so they don't block the event loop.
+
+    Several processes can share the database. Every write bumps a revision
+    row, which is all ``changed`` has to read. Announcement ids are row ids,
+    allocated from a counter row. The read state of every user is one row
+    holding the mark and the bitmap as little-endian bytes. Writing only
+    read state bumps a separate revision row, so other processes reload
+    just the read state then."""
+
+    shared = True
+
+    window = Integer(
+        100,
+        help="""Number of most recent announcements kept in memory.
+
+        These serve the latest announcement, the announcements page and
+        list requests they cover without touching the database.""",
+    ).tag(config=True)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._pid = None
+        with self._db:
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )"""
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)",
+                [("revision",), ("read_revision",)],
+            )
+            # Databases created before versioning have the same layout
+            self._db.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('version', ?)",
+                (SCHEMA_VERSION,),
+            )
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS announcements (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    entry TEXT NOT NULL
+                )"""
+            )
+            self._db.execute(
+                """CREATE INDEX IF NOT EXISTS announcements_timestamp
+                ON announcements (timestamp)"""
+            )
+            self._db.execute(
+                """INSERT OR IGNORE INTO meta (key, value)
+                SELECT 'last_id', COALESCE(MAX(id), 0) FROM announcements"""
+            )
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS read_state (
+                    user TEXT PRIMARY KEY,
+                    mark INTEGER NOT NULL,
+                    bits BLOB NOT NULL
+                )"""
+            )
+        _check_version(self._meta("version"), self.path)
+        with self._db:
+            # Older databases just lacked the read_state table
+            self._db.execute(
+                "UPDATE meta SET value = ? WHERE key = 'version' AND value < ?",
+                (SCHEMA_VERSION, SCHEMA_VERSION),
+            )
+        # Database revisions reflected in memory
+        self._seen = {key: self._revision(key) for key in ("revision", "read_revision")}
+
+    def _connect(self):
+        # Neither connections nor threads survive a fork, and the service
+        # forks worker processes after restoring the queue
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="announcement-sqlite")
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        # Readers in other processes don't block writers, nor the reverse
+        self._connection.execute("PRAGMA journal_mode=WAL")
+
+    @property
+    def _db(self):
+        self._connect()
+        return self._connection
+
+    def _meta(self, key):
+        return self._db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()[0]
+
+    def _revision(self, key="revision"):
+        return self._meta(key)
+
+    @contextmanager
+    def _transaction(self, key="revision"):
+        with self._db:
+            # Taking the write lock first keeps concurrent writers in order
+            self._db.execute("UPDATE meta SET value = value + 1 WHERE key = ?", (key,))
+            yield
+            revision = self._revision(key)
+        if revision == self._seen[key] + 1:
+            # Nobody else wrote since we last looked
+            self._seen[key] = revision
+
+    async def _run(self, func, *args):
+        self._connect()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    def _timestamp(self, announcement):
+        # Fixed precision so text order is time order
+        return announcement["timestamp"].isoformat(timespec="microseconds")
+
+    def _rows(self, announcements):
+        return [(a["id"], self._timestamp(a), dumps(a)) for a in announcements]
+
+    def _decode(self, rows):
+        announcements = []
+        for row_id, entry in rows:
+            announcement = _decode(loads(entry))
+            announcement["id"] = row_id
+            announcements.append(announcement)
+        return announcements
+
+    def _select(self, limit, before=None, after=None):
+        if after is None:
+            rows = self._db.execute(
+                """SELECT id, entry FROM announcements WHERE id < ?
+                ORDER BY id DESC LIMIT ?""",
+                (before if before is not None else 2**63 - 1, limit or -1),
+            ).fetchall()
+            rows.reverse()
+        else:
+            rows = self._db.execute(
+                """SELECT id, entry FROM announcements WHERE id > ? AND id < ?
+                ORDER BY id LIMIT ?""",
+                (after, before if before is not None else 2**63 - 1, limit),
+            ).fetchall()
+        return self._decode(rows)
+
+    def _select_window(self):
+        # Scheduled announcements, stored once posted, mustn't take the
+        # place of active ones in the window
+        active = self._db.execute(
+            """SELECT id, entry FROM announcements
+            WHERE json_extract(entry, '$.starts_at') IS NULL
+            ORDER BY id DESC LIMIT ?""",
+            (self.window or -1,),
+        ).fetchall()
+        scheduled = self._db.execute(
+            """SELECT id, entry FROM announcements
+            WHERE json_extract(entry, '$.starts_at') IS NOT NULL"""
+        ).fetchall()
+        return self._decode(sorted(active + scheduled))
+
+    def restore(self):
+        self._seen["revision"] = self._revision()
+        self.last_id = self._meta("last_id")
+        self._restore_read_state()
+        return self._select_window()
+
+    def _restore_read_state(self):
+        self._seen["read_revision"] = self._revision("read_revision")
+        self.read_state = {
+            user: (mark, int.from_bytes(bits, "little"))
+            for user, mark, bits in self._db.execute(
+                "SELECT user, mark, bits FROM read_state"
+            )
+        }
+        return self.read_state
+
+    async def reload(self):
+        return await self._run(self.restore)
+
+    async def changed(self):
+        return await self._run(self._revision) != self._seen["revision"]
+
+    async def read_changed(self):
+        revision = await self._run(self._revision, "read_revision")
+        return revision != self._seen["read_revision"]
+
+    async def reload_read_state(self):
+        return await self._run(self._restore_read_state)
+
+    async def page(self, limit, before=None, after=None):
+        return await self._run(self._select, limit, before, after)
+
+    def _next_id(self):
+        with self._db:
+            self._db.execute("UPDATE meta SET value = value + 1 WHERE key = 'last_id'")
+            return self._meta("last_id")
+
+    async def next_id(self):
+        return await self._run(self._next_id)
+
+    def _replace(self, announcements):
+        # Only rows of the in-memory queue are written over, rows in between
+        # may have been written by other processes
+        self._db.executemany(
+            """INSERT OR REPLACE INTO announcements (id, timestamp, entry)
+            VALUES (?, ?, ?)""",
+            self._rows(announcements),
+        )
+
+    def _save(self, announcements):
+        with self._transaction():
+            self._replace(announcements)
+
+    async def save(self, announcements):
+        await self._run(self._save, announcements)
+
+    def _apply(self, changes, announcements):
+        save = any(op == "save" for op, _ in changes)
+        read_only = all(op == "read" for op, _ in changes)
+        with self._transaction("read_revision" if read_only else "revision"):
+            if save:
+                self._replace(announcements)
+            for op, value in changes:
+                if op == "read":
+                    user, (mark, bits) = value
+                    bits = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO read_state VALUES (?, ?, ?)",
+                        (user, mark, bits),
+                    )
+                elif op == "save":
+                    continue
+                elif op == "append":
+                    # Retried after a failure, the same append may come again
+                    self._db.executemany(
+                        """INSERT OR REPLACE INTO announcements (id, timestamp, entry)
+                        VALUES (?, ?, ?)""",
+                        self._rows([value]),
+                    )
+                elif op == "purge":
+                    self._db.execute(
+                        "DELETE FROM announcements WHERE timestamp <= ?",
+                        (value.isoformat(timespec="microseconds"),),
+                    )
+                elif op == "remove":
+                    self._db.executemany(
+                        "DELETE FROM announcements WHERE id = ?", [(i,) for i in value]
+                    )
+                else:
+                    raise ValueError(f"unknown change {op!r}")
+
+    async def apply(self, changes, announcements):
+        # One transaction for the whole batch
+        await self._run(self._apply, changes, announcements)
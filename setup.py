@@ -8,8 +8,9 @@ long_description = (this_directory / "README.md").read_text()
 setup(
     author="R. C. Thomas, François Tessier, Narek Amirbekian, Mahendra Paipuri",
     author_email="rcthomas@lbl.gov",
-    data_files=[("share/jupyterhub/announcement/templates", ["templates/index.html"])],
+    data_files=[("share/jupyterhub/announcement/templates", ["templates/index.html", "templates/announcements.html"])],
     description="JupyterHub Announcement Service",
+    extras_require={"brotli": ["brotli"], "orjson": ["orjson"]},
     install_requires=open("requirements.txt").read().splitlines(),
     long_description=long_description,
     long_description_content_type="text/markdown",
@@ -1,9 +1,16 @@
 import time
 import pathlib
 import pytest
+import pytest_asyncio
 import socket
 import subprocess
 
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from jupyterhub_announcement.announcement import AnnouncementService
+
 
 ROOT_DIR = str(pathlib.Path(__file__).resolve().parent.parent)
 
@@ -73,3 +80,52 @@ def is_server_up(port):
             return s.connect_ex(('localhost', port)) == 0
     except Exception:
         return False
+
+
+@pytest.fixture
+def service_config():
+    """Extra AnnouncementService traits, override with parametrize"""
+    yield {}
+
+
+@pytest_asyncio.fixture
+async def service(tmp_path, service_config):
+    """Announcement service running in-process, without a hub"""
+    app = AnnouncementService(
+        config_file="",
+        cookie_secret_file=str(tmp_path / "cookie-secret"),
+        template_paths=[f"{ROOT_DIR}/templates"],
+        **service_config,
+    )
+    app.initialize([])
+    sock, port = bind_unused_port()
+    server = HTTPServer(app.app)
+    server.add_sockets([sock])
+    app.url = f"http://127.0.0.1:{port}{app.service_prefix}"
+
+    yield app
+
+    server.stop()
+    await server.close_all_connections()
+
+
+@pytest.fixture
+def hub_user(monkeypatch):
+    """Authenticate every request as this user model without asking a hub"""
+    from jupyterhub_announcement.handlers import AnnouncementHandler
+
+    user = {"name": "admin", "admin": True, "scopes": []}
+    monkeypatch.setattr(AnnouncementHandler, "get_current_user", lambda self: user)
+    yield user
+
+
+@pytest.fixture
+def fetch(service):
+    """Fetch a path under the service prefix, returning errors as responses"""
+    client = AsyncHTTPClient()
+
+    async def _fetch(path, **kwargs):
+        kwargs.setdefault("raise_error", False)
+        return await client.fetch(service.url + path, **kwargs)
+
+    return _fetch
@@ -1,5 +1,17 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
 import requests
 import pytest
+from tornado.testing import bind_unused_port
+
+from jupyterhub_announcement.queue import AnnouncementQueue
+from jupyterhub_announcement.storage import SQLiteStorage
+from tests.conftest import ROOT_DIR, is_server_up
 
 
 @pytest.mark.parametrize("user", ["normal", "admin"])
@@ -58,3 +70,49 @@ def test_api_resources(jupyterhub_server, user):
         else:
             expected = 403
         assert announcement.status_code == expected
+
+
+def test_num_processes(tmp_path):
+    """Test that workers sharing a port all serve updates from any of them"""
+    sock, port = bind_unused_port()
+    sock.close()
+    persist_path = str(tmp_path / "announcements.sqlite")
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "jupyterhub_announcement",
+            f"--AnnouncementService.port={port}",
+            "--AnnouncementService.num_processes=2",
+            f"--AnnouncementQueue.persist_path={persist_path}",
+            "--AnnouncementQueue.storage_class=jupyterhub_announcement.storage.SQLiteStorage",
+            "--AnnouncementQueue.refresh_interval=0.2",
+        ],
+        cwd=tmp_path,
+        env=dict(os.environ, PYTHONPATH=ROOT_DIR),
+        # Workers are forked by the service, stop them all together
+        start_new_session=True,
+    )
+    try:
+        start = time.time()
+        while not is_server_up(port) and time.time() - start < 30:
+            time.sleep(0.5)
+
+        # Post through the shared database, as another worker would
+
+        queue = AnnouncementQueue(persist_path=persist_path, storage_class=SQLiteStorage)
+
+        async def post():
+            # Updates are written in the background, wait for that
+            await queue.update("admin", "hello workers")
+            await queue.flush()
+
+        asyncio.run(post())
+        time.sleep(1)
+
+        for _ in range(20):
+            latest = requests.get(f"http://localhost:{port}/services/announcement/latest")
+            assert latest.json()["announcement"] == "hello workers"
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(10)
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+from jupyterhub.services.auth import HubOAuth
+
+from jupyterhub_announcement.auth import CachedHubOAuth, UserCache
+
+
+class Lookup:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = 0
+        self.fail = False
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("hub down")
+        return {"name": f"user{self.calls}"}
+
+
+@pytest.mark.asyncio
+async def test_user_cache_ttl():
+    lookup = Lookup()
+    cache = UserCache(ttl=0.1)
+    assert await cache.get("token", lookup) == {"name": "user1"}
+    assert await cache.get("token", lookup) == {"name": "user1"}
+    await asyncio.sleep(0.1)
+    assert await cache.get("token", lookup) == {"name": "user2"}
+    assert cache.stats() == dict(entries=1, hits=1, misses=2, coalesced=0)
+
+    cache.invalidate("token")
+    assert await cache.get("token", lookup) == {"name": "user3"}
+
+
+@pytest.mark.asyncio
+async def test_user_cache_lru():
+    lookup = Lookup()
+    cache = UserCache(max_entries=2)
+    await cache.get("a", lookup)
+    await cache.get("b", lookup)
+    await cache.get("a", lookup)
+    await cache.get("c", lookup)
+    assert len(cache) == 2
+
+    # b was used least recently
+
+    assert await cache.get("a", lookup) == {"name": "user1"}
+    assert await cache.get("b", lookup) == {"name": "user4"}
+
+
+@pytest.mark.asyncio
+async def test_user_cache_coalesces():
+    lookup = Lookup(delay=0.05)
+    cache = UserCache()
+    results = await asyncio.gather(*(cache.get("token", lookup) for _ in range(10)))
+    assert results == [{"name": "user1"}] * 10
+    assert lookup.calls == 1
+    assert cache.stats()["coalesced"] == 9
+
+    # Failures reach every waiter and are not cached
+
+    lookup.fail = True
+    cache.invalidate()
+    results = await asyncio.gather(
+        *(cache.get("token", lookup) for _ in range(2)), return_exceptions=True
+    )
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_cached_hub_oauth(monkeypatch):
+    lookup = Lookup()
+
+    async def check_hub_authorization(
+        self, url, api_token, cache_key=None, use_cache=True
+    ):
+        assert not use_cache
+        return await lookup()
+
+    monkeypatch.setattr(HubOAuth, "_check_hub_authorization", check_hub_authorization)
+    auth = CachedHubOAuth(api_token="secret")
+
+    # Logging out of the hub ends the session, which is part of the key
+
+    assert await auth.user_for_token("token", session_id="1", sync=False) == {
+        "name": "user1"
+    }
+    assert await auth.user_for_token("token", session_id="1", sync=False) == {
+        "name": "user1"
+    }
+    assert await auth.user_for_token("token", session_id="2", sync=False) == {
+        "name": "user2"
+    }
+    assert auth.user_cache.stats()["hits"] == 1
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+import pytest
+
+from jupyterhub_announcement.broadcast import BroadcastHub
+from jupyterhub_announcement.queue import AnnouncementQueue
+
+
+class Connection:
+    """Stand-in for a websocket handler whose writes finish on demand"""
+
+    def __init__(self):
+        self.messages = []
+        self.writes = []
+        self.closed = None
+
+    def write_message(self, message):
+        self.messages.append(json.loads(message))
+        future = asyncio.get_running_loop().create_future()
+        self.writes.append(future)
+        return future
+
+    def close(self, code=None, reason=None):
+        self.closed = code
+
+    async def drain(self):
+        while self.writes:
+            self.writes.pop(0).set_result(None)
+            await asyncio.sleep(0)
+
+
+@pytest.fixture
+def queue():
+    yield AnnouncementQueue()
+
+
+@pytest.mark.asyncio
+async def test_broadcast_batches(queue):
+    hub = BroadcastHub(queue, batch_delay=0.01)
+    connection = Connection()
+    hub.subscribe(connection)
+    assert len(hub) == 1
+    assert connection.messages == [{"announcement": ""}]
+
+    # Changes within the batch delay become one message
+
+    await queue.update("user1", "first")
+    await queue.update("user1", "second")
+    await asyncio.sleep(0.05)
+    assert [m["announcement"] for m in connection.messages] == ["", "second"]
+
+    hub.unsubscribe(connection)
+    assert hub.stats()["subscribers"] == 0
+
+
+@pytest.mark.asyncio
+async def test_broadcast_drop(queue):
+    hub = BroadcastHub(queue, max_pending=1)
+    connection = Connection()
+    hub.subscribe(connection)
+
+    # Pending write from subscribing, further messages are dropped
+
+    for announcement in ["first", "second"]:
+        await queue.update("user1", announcement)
+        hub.broadcast()
+    assert len(connection.messages) == 1
+    assert hub.stats()["dropped"] == 2
+
+    # Once writes finish the connection catches up with the latest
+
+    await connection.drain()
+    assert connection.messages[-1]["announcement"] == "second"
+    assert len(connection.messages) == 2
+
+
+@pytest.mark.asyncio
+async def test_broadcast_disconnect(queue):
+    hub = BroadcastHub(queue, max_pending=1, slow_consumer_policy="disconnect")
+    connection = Connection()
+    hub.subscribe(connection)
+
+    await queue.update("user1", "first")
+    hub.broadcast()
+    assert connection.closed == 1013
+    assert len(hub) == 0
+    assert hub.stats()["disconnected"] == 1
@@ -0,0 +1,34 @@
+import gzip
+
+import pytest
+
+from jupyterhub_announcement import compression
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("deflate, gzip;q=0.5", "gzip"),
+        ("GZIP ; Q=1", "gzip"),
+        ("gzip;q=0", None),
+        ("*", compression.ENCODINGS[0]),
+        ("*, gzip;q=0", "br" if compression.brotli else None),
+        ("gzip;q=bad", None),
+    ],
+)
+def test_negotiate(accept_encoding, expected):
+    assert compression.negotiate(accept_encoding) == expected
+
+
+def test_compress():
+    payload = b'{"announcement": "hello world"}' * 100
+    assert gzip.decompress(compression.compress(payload, "gzip")) == payload
+    # Compressing the same payload twice gives the same bytes
+    assert compression.compress(payload, "gzip") == compression.compress(
+        payload, "gzip"
+    )
+    with pytest.raises(ValueError):
+        compression.compress(payload, "compress")
@@ -3,6 +3,7 @@ import json
 
 import pytest
 
+from jupyterhub_announcement import encoder
 from jupyterhub_announcement.encoder import _JSONEncoder
 
 
@@ -48,3 +49,13 @@ def test_json_encoder_good(good_document, timestamp):
 def test_json_encoder_bad(bad_document, timestamp):
     with pytest.raises(TypeError):
         json.dumps(bad_document, cls=_JSONEncoder)
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_loads(good_document, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(encoder, "orjson", None)
+    elif encoder.orjson is None:
+        pytest.skip("orjson is not installed")
+    parsed = encoder.loads(encoder.dumps(good_document, indent=True))
+    assert parsed == dict(good_document, timestamp=good_document["timestamp"].isoformat())
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from jupyterhub_announcement.extra_info import ExtraInfoCache
+
+
+class Handler:
+    def __init__(self, name="user1"):
+        self.name = name
+
+    def get_current_user(self):
+        return {"name": self.name}
+
+
+class Hook:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = 0
+        self.fail = False
+
+    async def __call__(self, handler):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("backend down")
+        return f"{handler.name} {self.calls}"
+
+
+@pytest.mark.asyncio
+async def test_extra_info_ttl():
+    hook = Hook()
+    cache = ExtraInfoCache(hook, ttl=0.1, max_stale=0)
+    assert await cache.get(Handler()) == "user1 1"
+    assert await cache.get(Handler("user2")) == "user1 1"
+    await asyncio.sleep(0.1)
+    assert await cache.get(Handler()) == "user1 2"
+    assert hook.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_extra_info_per_user():
+    hook = Hook()
+    cache = ExtraInfoCache(hook, per_user=True, max_entries=2)
+    assert await cache.get(Handler("user1")) == "user1 1"
+    assert await cache.get(Handler("user2")) == "user2 2"
+    assert await cache.get(Handler("user1")) == "user1 1"
+    assert await cache.get(Handler("user3")) == "user3 3"
+    assert cache.stats()["entries"] == 2
+    assert await cache.get(Handler("user1")) == "user1 4"
+
+
+@pytest.mark.asyncio
+async def test_extra_info_single_flight():
+    hook = Hook(delay=0.05)
+    cache = ExtraInfoCache(hook)
+    results = await asyncio.gather(*(cache.get(Handler()) for _ in range(10)))
+    assert results == ["user1 1"] * 10
+    assert hook.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_extra_info_stale():
+    hook = Hook(delay=0.05)
+    cache = ExtraInfoCache(hook, ttl=0.2, timeout=0.02)
+
+    # Nothing to fall back to yet, the timed out call still fills the cache
+
+    assert await cache.get(Handler()) is None
+    assert cache.timeouts == 1
+    await asyncio.sleep(0.05)
+    assert await cache.get(Handler()) == "user1 1"
+    assert hook.calls == 1
+
+    # Expired results are served while they are refreshed in the background
+
+    await asyncio.sleep(0.2)
+    assert await cache.get(Handler()) == "user1 1"
+    await asyncio.sleep(0.1)
+    assert hook.calls == 2
+    assert await cache.get(Handler()) == "user1 2"
+
+    # Failures fall back to the last result while it is not too old
+
+    hook.fail = True
+    hook.delay = 0
+    await asyncio.sleep(0.2)
+    cache.max_stale = 0
+    assert await cache.get(Handler()) is None
+    cache.max_stale = 300
+    assert await cache.get(Handler()) == "user1 2"
+    await asyncio.sleep(0.01)
+    assert cache.errors == 2
@@ -0,0 +1,558 @@
+import asyncio
+import datetime
+import gzip
+import json
+from urllib.parse import urlencode, urlparse
+
+import pytest
+from tornado.httpclient import HTTPClientError
+from tornado.tcpclient import TCPClient
+from tornado.websocket import websocket_connect
+
+from jupyterhub_announcement.handlers import (
+    AnnouncementHandler,
+    AnnouncementStreamHandler,
+)
+
+
+@pytest.mark.asyncio
+async def test_latest(service, fetch):
+    response = await fetch("latest")
+    assert response.code == 200
+    assert json.loads(response.body) == {"announcement": ""}
+
+    await service.queue.update("user1", "hello world")
+    response = await fetch("latest")
+    assert json.loads(response.body)["announcement"] == "hello world"
+
+
+async def extra_info_hook(handler):
+    extra_info_hook.calls += 1
+    return "status: ok"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"extra_info_hook": extra_info_hook}])
+async def test_latest_extra(service, fetch):
+    extra_info_hook.calls = 0
+    await service.queue.update("user1", "hello world")
+
+    response = await fetch("latest?extra=separate")
+    assert json.loads(response.body)["extra"] == "status: ok"
+    response = await fetch("latest?extra=combined")
+    assert json.loads(response.body)["announcement"] == "hello world<br>status: ok"
+    response = await fetch("latest")
+    assert "extra" not in json.loads(response.body)
+    assert extra_info_hook.calls == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"extra_info_hook": extra_info_hook}])
+async def test_latest_extra_per_user(service, fetch, monkeypatch):
+    from jupyterhub_announcement.auth import CachedHubOAuth
+
+    service.extra_info.per_user = True
+    blocking = []
+    get_user = CachedHubOAuth.get_user
+
+    def check_get_user(self, handler, *, sync=True):
+        if sync and not hasattr(handler, "_cached_hub_user"):
+            blocking.append(handler.request.path)
+        return get_user(self, handler, sync=sync)
+
+    monkeypatch.setattr(CachedHubOAuth, "get_user", check_get_user)
+
+    # The user keying the cache is resolved without blocking the event loop
+
+    response = await fetch("latest?extra=separate")
+    assert json.loads(response.body)["extra"] == "status: ok"
+    assert blocking == []
+
+
+@pytest.mark.asyncio
+async def test_list(service, fetch):
+    for i in range(3):
+        await service.queue.update("user1", f"message {i}")
+
+    response = await fetch("list?limit=2")
+    assert response.code == 200
+    assert [a["announcement"] for a in json.loads(response.body)] == [
+        "message 1",
+        "message 2",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_changes(service, fetch):
+    await service.queue.update("user1", "message 0")
+
+    response = await fetch("changes")
+    changes = json.loads(response.body)
+    assert changes["reset"]
+    assert [a["announcement"] for a in changes["added"]] == ["message 0"]
+
+    await service.queue.update("user1", "message 1")
+    response = await fetch(f"changes?since={changes['revision']}")
+    changes = json.loads(response.body)
+    assert not changes["reset"]
+    assert [a["announcement"] for a in changes["added"]] == ["message 1"]
+    assert changes["removed"] == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", ["latest", "list", "changes"])
+async def test_conditional(service, fetch, path):
+    await service.queue.update("user1", "hello world")
+
+    response = await fetch(path)
+    etag = response.headers["Etag"]
+    last_modified = response.headers["Last-Modified"]
+
+    # Unchanged queue, header-only responses
+
+    response = await fetch(path, headers={"If-None-Match": etag})
+    assert response.code == 304
+    assert response.body == b""
+    response = await fetch(path, headers={"If-Modified-Since": last_modified})
+    assert response.code == 304
+
+    # A stale entity tag wins over a matching date
+
+    response = await fetch(
+        path, headers={"If-None-Match": '"stale"', "If-Modified-Since": last_modified}
+    )
+    assert response.code == 200
+
+    # Updates produce a new entity tag
+
+    await service.queue.update("user1", "changed")
+    response = await fetch(path, headers={"If-None-Match": etag})
+    assert response.code == 200
+    assert response.headers["Etag"] != etag
+
+    # Also within the same second
+
+    response = await fetch(path, headers={"If-Modified-Since": last_modified})
+    assert response.code == 200
+    assert response.headers["Last-Modified"] != last_modified
+
+
+async def open_stream(service, headers=""):
+    url = urlparse(service.url)
+    stream = await TCPClient().connect(url.hostname, url.port)
+    await stream.write(
+        f"GET {url.path}stream HTTP/1.1\r\nHost: localhost\r\n{headers}\r\n".encode()
+    )
+    head = await stream.read_until(b"\r\n\r\n")
+    return stream, head
+
+
+async def read_event(stream):
+    event = await asyncio.wait_for(stream.read_until(b"\n\n"), 5)
+    # Strip chunked transfer framing, events never span chunks here
+    return event.split(b"\r\n")[-1]
+
+
+@pytest.mark.asyncio
+async def test_compression(service, fetch):
+    for i in range(50):
+        await service.queue.update("user1", f"message {i}")
+    headers = {"Accept-Encoding": "gzip"}
+
+    # Large payloads are compressed once per revision
+
+    response = await fetch("list?limit=50", headers=headers, decompress_response=False)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    etag = response.headers["Etag"]
+    assert etag.endswith('-gzip"')
+    body = gzip.decompress(response.body)
+    assert len(json.loads(body)) == 50
+    again = await fetch("list?limit=50", headers=headers, decompress_response=False)
+    assert again.body == response.body
+
+    response = await fetch(
+        "list?limit=50",
+        headers=dict(headers, **{"If-None-Match": etag}),
+        decompress_response=False,
+    )
+    assert response.code == 304
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+    # Clients not accepting it and small payloads get the identity coding
+
+    response = await fetch("list?limit=50", decompress_response=False)
+    assert "Content-Encoding" not in response.headers
+    assert response.body == body
+    assert response.headers["Etag"] != etag
+    response = await fetch("latest", headers=headers, decompress_response=False)
+    assert "Content-Encoding" not in response.headers
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"compress_response": False}])
+async def test_compression_disabled(service, fetch):
+    for i in range(50):
+        await service.queue.update("user1", f"message {i}")
+    response = await fetch(
+        "list?limit=50",
+        headers={"Accept-Encoding": "gzip"},
+        decompress_response=False,
+    )
+    assert "Content-Encoding" not in response.headers
+    assert "Vary" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_stream(service):
+    await service.queue.update("user1", "hello world")
+    stream, head = await open_stream(service)
+    assert b"text/event-stream" in head
+
+    # The current announcement is sent right away
+
+    event = await read_event(stream)
+    assert event.startswith(f"id: {service.queue.version}\n".encode())
+    assert b'"hello world"' in event
+    assert AnnouncementStreamHandler.subscribers == 1
+
+    # Then one event per change
+
+    await service.queue.update("user1", "changed")
+    event = await read_event(stream)
+    assert event == service.queue.event_payload()
+
+    stream.close()
+    for _ in range(50):
+        if not AnnouncementStreamHandler.subscribers:
+            break
+        await asyncio.sleep(0.01)
+    assert AnnouncementStreamHandler.subscribers == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"stream_heartbeat_interval": 0.1}])
+async def test_stream_resume(service):
+    await service.queue.update("user1", "hello world")
+
+    # A current Last-Event-ID only gets heartbeats
+
+    stream, _ = await open_stream(
+        service, f"Last-Event-ID: {service.queue.version}\r\n"
+    )
+    assert await read_event(stream) == b":\n\n"
+    stream.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"stream_max_subscribers": 1}])
+async def test_stream_max_subscribers(service, fetch):
+    stream, _ = await open_stream(service)
+    response = await fetch("stream")
+    assert response.code == 503
+    stream.close()
+
+
+@pytest.mark.asyncio
+async def test_websocket(service):
+    service.broadcast.batch_delay = 0
+    await service.queue.update("user1", "hello world")
+    url = service.url.replace("http", "ws", 1) + "ws"
+    connection = await websocket_connect(url)
+
+    message = await asyncio.wait_for(connection.read_message(), 5)
+    assert json.loads(message)["announcement"] == "hello world"
+    assert len(service.broadcast) == 1
+
+    await service.queue.update("user1", "changed")
+    message = await asyncio.wait_for(connection.read_message(), 5)
+    assert json.loads(message)["announcement"] == "changed"
+
+    connection.close()
+    for _ in range(50):
+        if not len(service.broadcast):
+            break
+        await asyncio.sleep(0.01)
+    assert len(service.broadcast) == 0
+
+
+@pytest.mark.asyncio
+async def test_view(service, fetch, hub_user):
+    await service.queue.update("user1", "hello world")
+    response = await fetch("")
+    assert response.code == 200
+    assert b"hello world" in response.body
+
+    # Templates are compiled once and shared between requests
+
+    template = service.env.get_template("index.html")
+    await fetch("")
+    assert service.env.get_template("index.html") is template
+
+
+@pytest.mark.asyncio
+async def test_view_fragment(service, fetch, hub_user):
+    await service.queue.update("user1", "hello world")
+    await fetch("")
+
+    # The announcements section is rendered once per queue revision
+
+    def fragments():
+        return [v for k, v in service.queue._payloads.items() if k[0] == "html"]
+
+    (fragment,) = fragments()
+    response = await fetch("")
+    assert fragment in response.body.decode()
+    assert fragments() == [fragment]
+
+    await service.queue.update("user1", "changed")
+    response = await fetch("")
+    assert b"changed" in response.body
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"max_limit": 3}])
+async def test_list_pages(service, fetch):
+    for i in range(5):
+        await service.queue.update("user1", f"message {i}")
+
+    def ids(response):
+        return [a["id"] for a in json.loads(response.body)]
+
+    # Latest page, linking back to older ones
+
+    response = await fetch("list?limit=2")
+    assert ids(response) == [4, 5]
+    assert response.headers["Link"] == (
+        f'<{service.service_prefix}list?before=4&limit=2>; rel="next"'
+    )
+    response = await fetch("list?before=4&limit=2")
+    assert ids(response) == [2, 3]
+    response = await fetch("list?before=2&limit=2")
+    assert ids(response) == [1]
+    assert "Link" not in response.headers
+
+    # Catching up from a known id
+
+    response = await fetch("list?after=1&limit=2")
+    assert ids(response) == [2, 3]
+    assert "after=3" in response.headers["Link"]
+    response = await fetch("list?after=1&before=3")
+    assert ids(response) == [2]
+
+    # Page size is bounded
+
+    response = await fetch("list?limit=100")
+    assert ids(response) == [3, 4, 5]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("query", ["limit=x", "limit=0", "limit=-1", "before=x"])
+async def test_list_bad_arguments(fetch, query):
+    response = await fetch(f"list?{query}")
+    assert response.code == 400
+
+
+@pytest.fixture
+def post_announcement(fetch, hub_user, monkeypatch):
+    """Submit an announcement as hub_user, skipping the XSRF check"""
+    from jupyterhub_announcement.handlers import AnnouncementUpdateHandler
+
+    monkeypatch.setattr(
+        AnnouncementUpdateHandler, "check_xsrf_cookie", lambda self: None
+    )
+
+    async def _post(announcement, **fields):
+        return await fetch(
+            "update",
+            method="POST",
+            body=urlencode(dict(fields, announcement=announcement)),
+            follow_redirects=False,
+        )
+
+    return _post
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "service_config",
+    [{"allowed_tags": ["p", "strong"], "max_announcement_size": 100}],
+)
+async def test_update(service, fetch, post_announcement):
+    response = await post_announcement(
+        "<p><strong>hi</strong> <em>there</em></p>"
+    )
+    assert response.code == 302
+    assert service.queue.latest()["announcement"] == "<p><strong>hi</strong> there</p>"
+
+    response = await post_announcement("x" * 101)
+    assert response.code == 413
+    assert len(service.queue.announcements) == 1
+
+    response = await fetch("")
+    assert b"HTML tags allowed: p, strong" in response.body
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"sanitize_executor_size": 10}])
+async def test_update_executor(service, post_announcement):
+    response = await post_announcement("<p>" + "long " * 100 + "</p>")
+    assert response.code == 302
+    assert service.queue.latest()["announcement"] == "<p>" + "long " * 100 + "</p>"
+
+
+@pytest.mark.asyncio
+async def test_update_expires_at(service, post_announcement):
+    response = await post_announcement("maintenance", expires_at="2000-01-01T00:00")
+    assert response.code == 400
+    response = await post_announcement("maintenance", expires_at="tomorrow")
+    assert response.code == 400
+
+    expires_at = datetime.datetime.now() + datetime.timedelta(hours=1)
+    response = await post_announcement(
+        "maintenance", expires_at=expires_at.isoformat(timespec="minutes")
+    )
+    assert response.code == 302
+    assert service.queue.latest()["expires_at"] == expires_at.replace(
+        second=0, microsecond=0
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_starts_at(service, fetch, post_announcement):
+    starts_at = datetime.datetime.now() + datetime.timedelta(hours=1)
+    response = await post_announcement(
+        "maintenance",
+        starts_at=starts_at.isoformat(),
+        expires_at=starts_at.isoformat(),
+    )
+    assert response.code == 400
+
+    response = await post_announcement("maintenance", starts_at=starts_at.isoformat())
+    assert response.code == 302
+    assert service.queue.latest() == {"announcement": ""}
+    response = await fetch("")
+    assert b"Scheduled Announcements" in response.body
+
+
+@pytest.mark.asyncio
+async def test_metrics(service, fetch, hub_user):
+    registry = service.metrics_registry
+    latest = dict(handler="latest", code="200")
+
+    def sample(name, **labels):
+        return registry.get_sample_value(name, labels) or 0
+
+    requests = sample("announcement_request_duration_seconds_count", **latest)
+    await service.queue.update("user1", "hello world")
+    await fetch("latest")
+    await fetch("latest")
+
+    response = await fetch("metrics")
+    assert response.code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert "announcement_queue_length 1.0" in response.body.decode()
+    assert (
+        sample("announcement_request_duration_seconds_count", **latest)
+        == requests + 2
+    )
+    assert sample("announcement_response_size_bytes_count", handler="latest") >= 2
+    assert sample("announcement_payload_cache_requests_total", result="hit") == 1
+
+    # Other users need a metrics scope
+
+    hub_user.update(name="user1", admin=False)
+    response = await fetch("metrics")
+    assert response.code == 403
+    hub_user["scopes"] = ["read:metrics"]
+    response = await fetch("metrics")
+    assert response.code == 200
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"authenticate_api": True}])
+@pytest.mark.parametrize("path", ["latest", "list", "changes"])
+async def test_authenticate_api(service, fetch, monkeypatch, path):
+    response = await fetch(path)
+    assert response.code == 403
+
+    user = {"name": "user1", "admin": False, "scopes": []}
+    monkeypatch.setattr(AnnouncementHandler, "get_current_user", lambda self: user)
+    response = await fetch(path)
+    assert response.code == 200
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("service_config", [{"authenticate_api": True}])
+async def test_authenticate_push(service, fetch):
+    response = await fetch("stream")
+    assert response.code == 403
+    url = service.url.replace("http", "ws", 1) + "ws"
+    with pytest.raises(HTTPClientError) as error:
+        await websocket_connect(url)
+    assert error.value.code == 403
+    assert len(service.broadcast) == 0
+
+
+@pytest.mark.asyncio
+async def test_latest_audience(service, fetch, post_announcement, hub_user):
+    response = await post_announcement("gpu nodes down", groups="gpu, staff")
+    assert response.code == 302
+    assert service.queue.latest()["announcement"] == ""
+
+    hub_user.update(name="user1", admin=False, groups=["gpu"])
+    response = await fetch("latest")
+    assert json.loads(response.body)["announcement"] == "gpu nodes down"
+    assert response.headers["Cache-Control"] == "private, no-cache"
+    etag = response.headers["Etag"]
+    assert etag != service.queue.etag
+
+    hub_user["groups"] = []
+    response = await fetch("latest", headers={"If-None-Match": etag})
+    assert response.code == 200
+    assert json.loads(response.body)["announcement"] == ""
+    response = await fetch("list")
+    assert json.loads(response.body) == []
+
+
+@pytest.mark.asyncio
+async def test_read(service, fetch, monkeypatch):
+    from jupyterhub_announcement.handlers import AnnouncementReadHandler
+
+    monkeypatch.setattr(AnnouncementReadHandler, "check_xsrf_cookie", lambda self: None)
+    for i in range(3):
+        await service.queue.update("admin", f"message {i}")
+    response = await fetch("list?unread_only=1")
+    assert response.code == 403
+
+    user = {"name": "user1", "admin": False, "scopes": []}
+    monkeypatch.setattr(AnnouncementHandler, "get_current_user", lambda self: user)
+    response = await fetch("read", method="POST", body=urlencode(dict(ids="1, 3")))
+    assert response.code == 204
+    response = await fetch("list?unread_only=1")
+    assert [a["id"] for a in json.loads(response.body)] == [2]
+    assert response.headers["Cache-Control"] == "private, no-store"
+
+    response = await fetch(
+        "read",
+        method="POST",
+        body=json.dumps(dict(all="false")),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.code == 400
+    response = await fetch("read", method="POST", body=urlencode(dict(all="yes")))
+    assert response.code == 400
+    response = await fetch("list?unread_only=1")
+    assert [a["id"] for a in json.loads(response.body)] == [2]
+
+    response = await fetch(
+        "read",
+        method="POST",
+        body=json.dumps(dict(all=True)),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.code == 204
+    response = await fetch("list?unread_only=1")
+    assert json.loads(response.body) == []
+    response = await fetch("read", method="POST", body=urlencode(dict(ids="x")))
+    assert response.code == 400
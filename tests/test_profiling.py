@@ -0,0 +1,45 @@
+import asyncio
+import os
+import pstats
+import signal
+import tracemalloc
+
+import pytest
+
+from jupyterhub_announcement.profiling import Profiler
+
+
+def test_profiler_toggle(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path))
+    assert profiler.stop() == []
+
+    profiler.toggle()
+    assert profiler.running
+    assert tracemalloc.is_tracing()
+    sum(range(1000))
+
+    profiler.toggle()
+    assert not profiler.running
+    assert not tracemalloc.is_tracing()
+    profile, snapshot = sorted(tmp_path.iterdir())
+    assert profile.suffix == ".prof"
+    assert pstats.Stats(str(profile)).total_calls > 0
+    assert snapshot.suffix == ".tracemalloc"
+    assert tracemalloc.Snapshot.load(str(snapshot)).traces
+
+
+@pytest.mark.asyncio
+async def test_profiler_signal(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path), signal="SIGUSR2", trace_memory=False)
+    profiler.install()
+    try:
+        os.kill(os.getpid(), signal.SIGUSR2)
+        await asyncio.sleep(0.1)
+        assert profiler.running
+
+        os.kill(os.getpid(), signal.SIGUSR2)
+        await asyncio.sleep(0.1)
+        assert not profiler.running
+        assert [path.suffix for path in tmp_path.iterdir()] == [".prof"]
+    finally:
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR2)
@@ -1,8 +1,11 @@
+import asyncio
+import datetime
+import json
 import time
 
 import pytest
 
-from jupyterhub_announcement.queue import AnnouncementQueue
+from jupyterhub_announcement.queue import AnnouncementQueue, audience_keys
 
 
 @pytest.fixture
@@ -57,6 +60,7 @@ async def test_queue_persistent(announcement, tmp_path):
     # Update queue
 
     await queue.update(*announcement)
+    await queue.flush()
 
     # Drop the queue, make new one and verify the announcement is there
 
@@ -83,6 +87,7 @@ async def test_queue_purge(announcement, tmp_path, lifetime_days_2s):
 
     time.sleep(5)
     await queue.purge()
+    await queue.flush()
     assert len(queue) == 0
 
     # Drop the queue, make new one, should be no message
@@ -114,6 +119,308 @@ async def test_queue_persist_fail(tmp_path, announcement):
     await queue.update(*announcement)
     queue.announcements[0]["other"] = Whatever()
     try:
-        await queue._handle_persist()
+        assert not await queue._handle_persist()
     except Exception as err:
         assert False, f"'_handle_persist' raised exception {err}"
+
+
+@pytest.mark.asyncio
+async def test_queue_payloads(announcement):
+    queue = AnnouncementQueue()
+
+    # Empty queue still has payloads
+
+    assert json.loads(queue.latest_payload()) == {"announcement": ""}
+    assert json.loads(await queue.list_payload(5)) == []
+
+    # Payloads are reused until the queue changes
+
+    await queue.update(*announcement)
+    revision = queue.revision
+    latest = queue.latest_payload()
+    assert latest is queue.latest_payload()
+    assert json.loads(latest)["announcement"] == announcement[1]
+
+    await queue.update("user2", "second")
+    assert queue.revision > revision
+    assert json.loads(queue.latest_payload())["user"] == "user2"
+    assert [a["user"] for a in json.loads(await queue.list_payload(1))] == ["user2"]
+    assert len(json.loads(await queue.list_payload(5))) == 2
+    assert await queue.list_payload(5) is await queue.list_payload(5)
+    hits = queue.cache_hits
+    await queue.list_payload(5)
+    assert queue.cache_hits == hits + 1
+
+    # Purging something invalidates the payloads too
+
+    queue.lifetime_days = 0
+    await queue.purge()
+    assert json.loads(await queue.list_payload(5)) == []
+
+
+def test_queue_restore_assigns_ids(tmp_path):
+
+    # Announcements persisted before they had ids get them in order
+
+    persist_path = tmp_path / "announcements.json"
+    persist_path.write_text(
+        json.dumps(
+            [
+                {"user": "user1", "announcement": "a", "timestamp": "2022-05-17T16:59:23"},
+                {"user": "user1", "announcement": "b", "timestamp": "2022-05-17T17:59:23"},
+            ]
+        )
+    )
+    queue = AnnouncementQueue(persist_path=str(persist_path))
+    assert [a["id"] for a in queue.announcements] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_queue_changes(announcement):
+    queue = AnnouncementQueue(max_changes=3)
+
+    # Unknown revisions reset clients to the whole queue
+
+    await queue.update(*announcement)
+    changes = queue.changes(None)
+    assert changes["reset"]
+    assert [a["id"] for a in changes["added"]] == [1]
+    since = changes["revision"]
+
+    # Nothing new
+
+    changes = queue.changes(since)
+    assert not changes["reset"]
+    assert changes["added"] == changes["removed"] == []
+
+    # Additions and purges since a known revision
+
+    await queue.update(*announcement)
+    changes = queue.changes(since)
+    assert [a["id"] for a in changes["added"]] == [2]
+    queue.lifetime_days = 0
+    await queue.purge()
+    changes = queue.changes(since)
+    assert changes["added"] == []
+    assert changes["removed"] == [1, 2]
+    assert json.loads(queue.changes_payload(since)) == json.loads(
+        json.dumps(changes)
+    )
+
+    # Only so many changes are remembered
+
+    for _ in range(3):
+        await queue.update(*announcement)
+    assert queue.changes(since)["reset"]
+    assert queue.changes("not-a-revision")["reset"]
+
+
+@pytest.mark.asyncio
+async def test_queue_changes_bounded(announcement):
+    queue = AnnouncementQueue(max_changes=100)
+    for _ in range(50):
+        await queue.update(*announcement)
+
+    # Changes since any number of revisions take bounded memory
+
+    for revision in range(50):
+        queue.changes_payload(f"{queue.version.rpartition('-')[0]}-{revision}")
+    assert len([key for key in queue._payloads if key[0] == "changes"]) == 32
+
+
+@pytest.mark.asyncio
+async def test_queue_expiry(announcement):
+    queue = AnnouncementQueue()
+    changes = []
+    queue.add_listener(lambda: changes.append(queue.revision))
+    queue.start_expiry()
+
+    # Announcements go away at their expiry time without a purge call
+
+    soon = datetime.datetime.now() + datetime.timedelta(seconds=0.2)
+    await queue.update("user1", "maintenance", expires_at=soon)
+    await queue.update(*announcement)
+    assert queue.expiry(queue.announcements[0]) == soon
+    await asyncio.sleep(0.1)
+    assert len(queue) == 2
+    await asyncio.sleep(0.2)
+    assert [a["announcement"] for a in queue.announcements] == ["hello world"]
+    assert len(changes) == 3
+
+    # Shortening the lifetime reschedules the others
+
+    queue.lifetime_days = 0.2 / 86400
+    await asyncio.sleep(0.1)
+    assert len(queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_scheduled(announcement, tmp_path):
+    persist_path = str(tmp_path / "announcements.json")
+    queue = AnnouncementQueue(persist_path=persist_path)
+    queue.start_expiry()
+    payloads = []
+    queue.add_listener(lambda: payloads.append(queue.latest_payload()))
+
+    # Scheduled announcements are held back until their start time
+
+    starts_at = datetime.datetime.now() + datetime.timedelta(seconds=0.2)
+    await queue.update("user1", "maintenance", starts_at=starts_at)
+    await queue.update(*announcement)
+    assert [a["announcement"] for a in queue.scheduled()] == ["maintenance"]
+    assert queue.latest()["announcement"] == "hello world"
+
+    # Scheduled announcements survive a restart
+
+    await queue.flush()
+    restored = AnnouncementQueue(persist_path=persist_path)
+    assert [a["announcement"] for a in restored.announcements] == ["hello world"]
+    assert [a["id"] for a in restored.scheduled()] == [1]
+
+    # Once started they are the latest, under a new id
+
+    await asyncio.sleep(0.3)
+    latest = json.loads(payloads[-1])
+    assert latest["announcement"] == "maintenance"
+    assert latest["id"] == 3
+    assert "starts_at" not in latest
+    assert queue.scheduled() == []
+
+    await queue.flush()
+    restored = AnnouncementQueue(persist_path=persist_path)
+    assert [a["id"] for a in restored.announcements] == [2, 3]
+    assert restored.scheduled() == []
+
+
+@pytest.mark.asyncio
+async def test_queue_persist_batches(tmp_path):
+    persist_path = str(tmp_path / "announcements.json")
+    queue = AnnouncementQueue(persist_path=persist_path)
+
+    # Updates return without waiting for the disk
+
+    futures = [await queue.update("user1", f"message {i}") for i in range(5)]
+    assert queue.persister.busy
+    assert not any(future.done() for future in futures)
+
+    # A burst of updates is written once
+
+    assert all(await asyncio.gather(*futures))
+    assert not queue.persister.busy
+    stats = queue.persister.stats()
+    assert stats["writes"] == 1
+    assert stats["changes"] == 5
+    assert stats["coalesced"] == 4
+
+    with open(persist_path) as stream:
+        assert len(json.load(stream)["announcements"]) == 5
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+@pytest.mark.asyncio
+async def test_queue_audience():
+    queue = AnnouncementQueue()
+    await queue.update("admin", "everyone")
+    await queue.update("admin", "gpu", audience=dict(groups=["gpu"]))
+    await queue.update("admin", "user2", audience=dict(users=["user2"], groups=[]))
+    await queue.update("admin", "gpu or staff", audience=dict(groups=["gpu", "staff"]))
+    assert queue.announcements[2]["audience"] == {"users": ["user2"]}
+    assert queue.targeted
+
+    anonymous = audience_keys(None)
+    gpu = audience_keys(dict(name="user1", groups=["gpu", "staff"]))
+    other = audience_keys(dict(name="user3", groups=["cpu"], scopes=["self"]))
+
+    def shown(keys):
+        return [a["announcement"] for a in queue.visible(keys)]
+
+    assert shown(anonymous) == ["everyone"]
+    assert shown(gpu) == ["everyone", "gpu", "gpu or staff"]
+    assert shown(audience_keys(dict(name="user2"))) == ["everyone", "user2"]
+    assert queue.latest(gpu)["announcement"] == "gpu or staff"
+    assert queue.latest(anonymous)["announcement"] == "everyone"
+
+    # Users matching no targeted key share the payloads for everyone
+
+    assert queue.shown(other) == frozenset()
+    assert queue.latest_payload(other) is queue.latest_payload()
+    assert queue.etag_for(other) == queue.etag
+    assert queue.etag_for(gpu) != queue.etag
+
+    page = await queue.page(2, keys=gpu)
+    assert [a["announcement"] for a in page] == ["gpu", "gpu or staff"]
+    changes = queue.changes(None)
+    assert [a["announcement"] for a in changes["added"]] == ["everyone"]
+    since = queue.version
+    await queue.update("admin", "staff", audience=dict(groups=["staff"]))
+    await queue.update("admin", "cpu", audience=dict(groups=["cpu"]))
+    changes = queue._changes_since(queue._since(since), gpu)
+    assert [a["announcement"] for a in changes["added"]] == ["staff"]
+
+
+@pytest.mark.asyncio
+async def test_queue_read(tmp_path):
+    persist_path = str(tmp_path / "announcements.json")
+    queue = AnnouncementQueue(persist_path=persist_path)
+    for i in range(4):
+        await queue.update("admin", f"message {i}")
+    tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+    await queue.update("admin", "scheduled", starts_at=tomorrow)
+
+    def unread(user, limit=10, **kwargs):
+        return [a["id"] for a in queue.unread(user, limit, **kwargs)]
+
+    assert await queue.mark_read("user1", [2, 4]) is not None
+    assert unread("user1") == [1, 3]
+    assert unread("user1", 1) == [3]
+    assert unread("user1", 1, after=1) == [3]
+    assert unread("user2") == [1, 2, 3, 4]
+    assert await queue.mark_read("user1", [2]) is None
+
+    # Marking all leaves announcements not posted yet unread
+
+    assert await (await queue.mark_read("user1", all=True))
+    assert queue.read_state.get("user1") == (4, 0)
+    assert not queue.read_state.is_read("user1", 5)
+
+    new_queue = AnnouncementQueue(persist_path=persist_path)
+    assert new_queue.read_state.get("user1") == (4, 0)
+    assert [a["id"] for a in new_queue.unread("user2", 2)] == [3, 4]
+
+
+@pytest.mark.asyncio
+async def test_queue_reseed(announcement):
+    queue = AnnouncementQueue()
+    await queue.update(*announcement)
+    version, etag = queue.version, queue.etag
+
+    # Forked workers get validators of their own
+
+    queue.reseed()
+    assert queue.revision == 1
+    assert queue.version != version
+    assert queue.etag != etag
+    assert queue.changes(version)["reset"]
+
+
+@pytest.mark.asyncio
+async def test_queue_audience_cache():
+    queue = AnnouncementQueue()
+    groups = [f"group{i}" for i in range(40)]
+    for group in groups:
+        await queue.update("admin", group, audience=dict(groups=[group]))
+    await queue.list_payload(5)
+    for limit in range(1, 40):
+        await queue.list_payload(limit)
+
+    # Every audience keeps its views, list pages notwithstanding
+
+    users = [audience_keys(dict(name="user1", groups=[group])) for group in groups]
+    for keys in users:
+        queue.latest_payload(keys)
+        queue.etag_for(keys)
+    misses = queue.cache_misses
+    for keys in users:
+        assert json.loads(queue.latest_payload(keys))["announcement"] in groups
+        queue.etag_for(keys)
+    assert queue.cache_misses == misses
@@ -0,0 +1,44 @@
+from jupyterhub_announcement.read_state import ReadState, decode_state, encode_state
+
+
+def test_read_state_mark():
+    read_state = ReadState()
+    assert not read_state.is_read("user1", 1)
+
+    # Ids read out of order are kept as bits above the mark
+
+    assert read_state.mark("user1", [3, 5], last=5) == (0, 0b10100)
+    assert read_state.is_read("user1", 3)
+    assert not read_state.is_read("user1", 4)
+
+    # Reading the gaps folds the bits into the mark
+
+    assert read_state.mark("user1", [1, 2], last=5) == (3, 0b10)
+    assert read_state.mark("user1", [4], last=5) == (5, 0)
+    assert read_state.mark("user1", [4, 5], last=5) is None
+    assert read_state.get("user2") == (0, 0)
+
+
+def test_read_state_floor():
+    read_state = ReadState()
+    read_state.mark("user1", [12, 20], last=20)
+
+    # Ids up to the floor count as read, ids not posted yet are ignored
+
+    assert read_state.mark("user1", [30], floor=10, last=20) == (10, 0b1000000010)
+    assert read_state.mark("user1", [11], floor=10, last=20) == (12, 0b10000000)
+    assert read_state.mark("user1", [], floor=20, last=20) == (20, 0)
+
+
+def test_read_state_unread():
+    read_state = ReadState()
+    announcements = [dict(id=i) for i in range(1, 6)]
+    read_state.mark("user1", [1, 2, 4], last=5)
+    assert [a["id"] for a in read_state.unread("user1", announcements)] == [3, 5]
+    assert len(read_state.unread("user2", announcements)) == 5
+
+
+def test_read_state_encoding():
+    state = (3, 1 << 70 | 1)
+    assert encode_state(state) == [3, "400000000000000001"]
+    assert decode_state(encode_state(state)) == state
@@ -0,0 +1,460 @@
+import datetime
+import json
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+from traitlets.config import Config
+
+from jupyterhub_announcement.queue import AnnouncementQueue
+from jupyterhub_announcement.storage import (
+    JournalStorage,
+    JSONFileStorage,
+    SQLiteStorage,
+)
+
+
+@pytest.fixture
+def persist_path(tmp_path):
+    yield str(tmp_path / "announcements.jsonl")
+
+
+def journal_queue(persist_path, **kwargs):
+    return AnnouncementQueue(
+        persist_path=persist_path, storage_class=JournalStorage, **kwargs
+    )
+
+
+def write_old(persist_path, count):
+    timestamp = datetime.datetime.now() - datetime.timedelta(days=30)
+    with open(persist_path, "w") as stream:
+        for i in range(count):
+            announcement = dict(
+                user="user1", announcement=f"old {i}", timestamp=timestamp.isoformat()
+            )
+            stream.write(json.dumps(dict(op="add", announcement=announcement)) + "\n")
+
+
+def records(persist_path):
+    with open(persist_path) as stream:
+        return [json.loads(line) for line in stream]
+
+
+@pytest.mark.asyncio
+async def test_journal_appends(persist_path):
+    queue = journal_queue(persist_path)
+    await queue.update("user1", "first")
+    await queue.update("user1", "second")
+    await queue.flush()
+
+    # One record per update
+
+    assert [r["op"] for r in records(persist_path)] == ["add", "add"]
+
+    new_queue = journal_queue(persist_path)
+    assert [a["announcement"] for a in new_queue.announcements] == [
+        "first",
+        "second",
+    ]
+    assert isinstance(new_queue.announcements[0]["timestamp"], datetime.datetime)
+
+
+@pytest.mark.asyncio
+async def test_journal_purge(persist_path):
+    write_old(persist_path, 1)
+    queue = journal_queue(persist_path)
+    await queue.update("user1", "new")
+
+    # Purges are recorded as tombstones and replayed at restore
+
+    await queue.purge()
+    await queue.flush()
+    assert [r["op"] for r in records(persist_path)] == ["add", "add", "purge"]
+    new_queue = journal_queue(persist_path)
+    assert [a["announcement"] for a in new_queue.announcements] == ["new"]
+
+
+@pytest.mark.asyncio
+async def test_journal_expires_at(persist_path):
+    queue = journal_queue(persist_path)
+    soon = datetime.datetime.now() + datetime.timedelta(seconds=0.1)
+    await queue.update("user1", "maintenance", expires_at=soon)
+    await queue.update("user1", "welcome")
+
+    # Early expiry removes announcements by id
+
+    time.sleep(0.1)
+    await queue.purge()
+    await queue.flush()
+    assert [r["op"] for r in records(persist_path)] == ["add", "add", "remove"]
+    new_queue = journal_queue(persist_path)
+    assert [a["announcement"] for a in new_queue.announcements] == ["welcome"]
+
+
+@pytest.mark.asyncio
+async def test_journal_compacts(persist_path):
+    write_old(persist_path, 3)
+    queue = journal_queue(persist_path)
+    queue.storage.max_dead_records = 3
+    await queue.update("user1", "new")
+
+    # Three purged records and the purge itself go away
+
+    await queue.purge()
+    await queue.flush()
+    assert records(persist_path) == [
+        dict(op="meta", version=2, last_id=4),
+        dict(op="add", announcement=json.loads(queue.latest_payload())),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_journal_write_failure(persist_path, monkeypatch):
+    queue = journal_queue(persist_path)
+    apply = queue.storage.apply
+
+    async def fail(changes, announcements):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(queue.storage, "apply", fail)
+    assert not await (await queue.update("user1", "one"))
+    monkeypatch.setattr(queue.storage, "apply", apply)
+
+    # The next batch saves what the failed one lost
+
+    assert await (await queue.update("user1", "two"))
+    new_queue = journal_queue(persist_path)
+    assert [a["announcement"] for a in new_queue.announcements] == ["one", "two"]
+
+
+@pytest.mark.asyncio
+async def test_journal_truncated(persist_path):
+    queue = journal_queue(persist_path)
+    await queue.update("user1", "complete")
+    await queue.flush()
+    with open(persist_path, "a") as stream:
+        stream.write('{"op": "add", "announcem')
+
+    # A record cut short by a crash is skipped
+
+    new_queue = journal_queue(persist_path)
+    assert [a["announcement"] for a in new_queue.announcements] == ["complete"]
+
+
+@pytest.mark.asyncio
+async def test_journal_converts_json_file(persist_path):
+    queue = AnnouncementQueue(persist_path=persist_path)
+    assert isinstance(queue.storage, JSONFileStorage)
+    await queue.update("user1", "hello world")
+    await queue.flush()
+
+    new_queue = journal_queue(persist_path)
+    assert len(new_queue) == 1
+    assert [r["op"] for r in records(persist_path)] == ["meta", "add"]
+
+
+@pytest.mark.asyncio
+async def test_json_file_schema(tmp_path):
+    persist_path = str(tmp_path / "announcements.json")
+    queue = AnnouncementQueue(persist_path=persist_path)
+    await queue.update("2024-01-01", "2024-01-01T12:00")
+    await queue.flush()
+    with open(persist_path) as stream:
+        document = json.load(stream)
+    assert document["version"] == 2
+
+    # Only time fields are parsed as dates
+
+    new_queue = AnnouncementQueue(persist_path=persist_path)
+    assert new_queue.announcements[0]["user"] == "2024-01-01"
+    assert new_queue.announcements[0]["announcement"] == "2024-01-01T12:00"
+    assert isinstance(new_queue.announcements[0]["timestamp"], datetime.datetime)
+
+    # Lists written before versioning are read as well, newer versions not
+
+    with open(persist_path, "w") as stream:
+        json.dump(document["announcements"], stream)
+    assert len(AnnouncementQueue(persist_path=persist_path)) == 1
+    with open(persist_path, "w") as stream:
+        json.dump(dict(document, version=3), stream)
+    assert len(AnnouncementQueue(persist_path=persist_path)) == 0
+
+
+def sqlite_queue(tmp_path, window=2, **kwargs):
+    return AnnouncementQueue(
+        persist_path=str(tmp_path / "announcements.sqlite"),
+        storage_class=SQLiteStorage,
+        config=Config({"SQLiteStorage": {"window": window}}),
+        **kwargs,
+    )
+
+
+@pytest.mark.asyncio
+async def test_sqlite_window(tmp_path):
+    queue = sqlite_queue(tmp_path)
+    for i in range(4):
+        await queue.update("user1", f"message {i}")
+
+    # Only the window is kept in memory, older history is queried
+
+    assert [a["announcement"] for a in queue.announcements] == [
+        "message 2",
+        "message 3",
+    ]
+    history = json.loads(await queue.list_payload(3))
+    assert [a["announcement"] for a in history] == [
+        "message 1",
+        "message 2",
+        "message 3",
+    ]
+    assert len(json.loads(await queue.list_payload(10))) == 4
+
+    # Restoring loads the window only
+
+    await queue.flush()
+    new_queue = sqlite_queue(tmp_path)
+    assert [a["announcement"] for a in new_queue.announcements] == [
+        "message 2",
+        "message 3",
+    ]
+    assert isinstance(new_queue.announcements[0]["timestamp"], datetime.datetime)
+    assert len(await new_queue.page(10)) == 4
+
+
+@pytest.mark.asyncio
+async def test_sqlite_window_changes(tmp_path):
+    queue = sqlite_queue(tmp_path)
+    await queue.update("user1", "message 0")
+    since = queue.version
+    await queue.update("user1", "message 1")
+    await queue.update("user1", "message 2")
+
+    # Announcements leaving the window are still there for clients
+
+    changes = queue.changes(since)
+    assert [a["id"] for a in changes["added"]] == [2, 3]
+    assert changes["removed"] == []
+    assert 1 not in queue._known
+
+
+@pytest.mark.asyncio
+async def test_sqlite_purge(tmp_path):
+    queue = sqlite_queue(tmp_path, window=1)
+    await queue.update("user1", "old")
+    await queue.update("user1", "new")
+
+    # Purging reaches announcements outside the window
+
+    queue.lifetime_days = 0
+    await queue.purge()
+    assert len(queue) == 0
+    assert await queue.page(10) == []
+
+
+@pytest.mark.asyncio
+async def test_sqlite_expires_at(tmp_path):
+    queue = sqlite_queue(tmp_path)
+    soon = datetime.datetime.now() + datetime.timedelta(seconds=0.1)
+    await queue.update("user1", "maintenance", expires_at=soon)
+    await queue.update("user1", "welcome")
+
+    time.sleep(0.1)
+    await queue.purge()
+    await queue.flush()
+    new_queue = sqlite_queue(tmp_path)
+    assert [a["announcement"] for a in new_queue.announcements] == ["welcome"]
+    assert len(await new_queue.page(10)) == 1
+
+
+@pytest.mark.asyncio
+async def test_sqlite_shared(tmp_path):
+    replica1 = sqlite_queue(tmp_path)
+    replica2 = sqlite_queue(tmp_path)
+    assert replica1.shared
+
+    # Own writes don't count as changes
+
+    await replica1.update("user1", "hello world")
+    await replica1.flush()
+    assert not await replica1.storage.changed()
+
+    # The other replica picks them up on refresh
+
+    revision = replica2.revision
+    await replica2.refresh()
+    assert replica2.revision > revision
+    assert json.loads(replica2.latest_payload())["announcement"] == "hello world"
+
+    # Nothing changed, nothing to do
+
+    revision = replica2.revision
+    await replica2.refresh()
+    assert replica2.revision == revision
+
+
+@pytest.mark.asyncio
+async def test_sqlite_shared_process(tmp_path):
+    queue = sqlite_queue(tmp_path)
+    script = f"""
+import asyncio
+from traitlets.config import Config
+from jupyterhub_announcement.queue import AnnouncementQueue
+from jupyterhub_announcement.storage import SQLiteStorage
+
+queue = AnnouncementQueue(
+    persist_path={str(tmp_path / "announcements.sqlite")!r},
+    storage_class=SQLiteStorage,
+)
+
+
+async def main():
+    await queue.update("user2", "from another process")
+    await queue.flush()
+
+
+asyncio.run(main())
+"""
+    subprocess.run([sys.executable, "-c", script], check=True)
+
+    await queue.refresh()
+    assert queue.announcements[-1]["announcement"] == "from another process"
+
+
+@pytest.mark.asyncio
+async def test_sqlite_pages(tmp_path):
+    queue = sqlite_queue(tmp_path)
+    for i in range(5):
+        await queue.update("user1", f"message {i}")
+
+    # Pages reaching past the window come from the database
+
+    assert [a["id"] for a in await queue.page(2, before=4)] == [2, 3]
+    assert [a["id"] for a in await queue.page(3, after=1)] == [2, 3, 4]
+    assert [a["id"] for a in await queue.page(2)] == [4, 5]
+
+
+@pytest.mark.asyncio
+async def test_sqlite_scheduled(tmp_path):
+    queue = sqlite_queue(tmp_path, window=3)
+    for i in range(4):
+        await queue.update("user1", f"message {i}")
+    tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+    await queue.update("user1", "scheduled", starts_at=tomorrow)
+    await queue.flush()
+
+    # Pages read from the database skip announcements not started yet
+
+    assert len(await queue.page(10)) == 4
+    assert len(await queue.page(10, after=0)) == 4
+    assert "scheduled" not in {a["announcement"] for a in await queue.page(10)}
+
+    # Restoring keeps a full window of active announcements
+
+    new_queue = sqlite_queue(tmp_path, window=3)
+    assert [a["announcement"] for a in new_queue.announcements] == [
+        "message 1",
+        "message 2",
+        "message 3",
+    ]
+    assert [a["announcement"] for a in new_queue.scheduled()] == ["scheduled"]
+
+
+@pytest.mark.asyncio
+async def test_journal_ids(persist_path):
+    queue = journal_queue(persist_path)
+    queue.storage.max_dead_records = 0
+    await queue.update("user1", "first")
+    queue.lifetime_days = 0
+    await queue.purge()
+    await queue.flush()
+
+    # Ids of purged announcements are not reused after a restart
+
+    new_queue = journal_queue(persist_path)
+    await new_queue.update("user1", "second")
+    assert new_queue.announcements[0]["id"] == 2
+
+
+@pytest.mark.asyncio
+async def test_journal_read_state(persist_path):
+    queue = journal_queue(persist_path)
+    queue.storage.max_dead_records = 1
+    for i in range(3):
+        await queue.update("user1", f"message {i}")
+    await queue.mark_read("user1", [1, 3])
+    await queue.mark_read("user1", [2])
+    await queue.flush()
+
+    # Every change of a read state is appended, compaction keeps the last
+
+    assert [r["op"] for r in records(persist_path)][-2:] == ["read", "read"]
+    new_queue = journal_queue(persist_path)
+    assert new_queue.read_state.get("user1") == (3, 0)
+    queue.lifetime_days = 0
+    await queue.purge()
+    await queue.flush()
+    assert [r["op"] for r in records(persist_path)] == ["meta", "read"]
+    assert journal_queue(persist_path).read_state.get("user1") == (3, 0)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_write_failure(tmp_path, monkeypatch):
+    replica1 = sqlite_queue(tmp_path)
+    replica2 = sqlite_queue(tmp_path)
+    apply = replica1.storage.apply
+
+    async def fail(changes, announcements):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(replica1.storage, "apply", fail)
+    assert not await (await replica1.update("user1", "one"))
+    monkeypatch.setattr(replica1.storage, "apply", apply)
+    assert await (await replica2.update("user2", "other replica"))
+
+    # The failed changes are written again, without touching other rows
+
+    assert await (await replica1.update("user1", "two"))
+    history = [a["announcement"] for a in await sqlite_queue(tmp_path).page(10)]
+    assert history == ["one", "other replica", "two"]
+
+
+@pytest.mark.asyncio
+async def test_sqlite_read_state(tmp_path):
+    replica1 = sqlite_queue(tmp_path)
+    replica2 = sqlite_queue(tmp_path)
+    for i in range(3):
+        await replica1.update("user1", f"message {i}")
+    await replica1.flush()
+    await replica2.refresh()
+
+    # Other replicas reload only the read state, without a new revision.
+    # Ids older than the window count as read.
+
+    await replica1.mark_read("user1", [3])
+    await replica1.flush()
+    assert not await replica1.storage.read_changed()
+    revision = replica2.revision
+    await replica2.refresh()
+    assert replica2.revision == revision
+    assert replica2.read_state.get("user1") == (1, 0b10)
+    assert [a["id"] for a in replica2.unread("user1", 10)] == [2]
+    assert sqlite_queue(tmp_path).read_state.get("user1") == (1, 0b10)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_read_refreshed(tmp_path):
+    replica1 = sqlite_queue(tmp_path, window=10)
+    replica2 = sqlite_queue(tmp_path, window=10)
+    for i in range(3):
+        await replica1.update("user1", f"message {i}")
+    await replica1.flush()
+
+    # Announcements learned about on refresh can be marked read
+
+    await replica2.refresh()
+    assert await replica2.mark_read("user1", [2]) is not None
+    assert [a["id"] for a in replica2.unread("user1", 10)] == [1, 3]
+    assert await replica2.mark_read("user2", all=True) is not None
+    assert replica2.unread("user2", 10) == []